@@ -0,0 +1,163 @@
+"""
+Benchmarks for airspeed velocity (asv)
+
+Run with `asv run` (or `asv dev` for a quick check of the working tree) in the
+repository root. Each benchmark is parametrized by the synthetic graph (see
+generators.py), the number of keys and the size of each key.
+"""
+
+import numpy as np
+
+from junctiontree import beliefpropagation as bp
+import junctiontree.junctiontree as jt
+
+from .generators import graphs
+
+
+class Compile:
+    """Triangulation and Junction tree construction"""
+
+    params = (list(graphs), [100, 1000, 10000], [2, 4])
+    param_names = ["graph", "num_keys", "size"]
+
+
+    def setup(self, graph, num_keys, size):
+        (self.factors, self.sizes, _) = graphs[graph](num_keys, size)
+        (_, _, self.maxcliques, _) = bp.find_triangulation(
+            self.factors,
+            self.sizes
+        )
+
+
+    def time_find_triangulation(self, graph, num_keys, size):
+        bp.find_triangulation(self.factors, self.sizes)
+
+
+    def time_estimate_cost(self, graph, num_keys, size):
+        bp.estimate_cost(self.factors, self.sizes)
+
+
+    def time_construct_junction_tree(self, graph, num_keys, size):
+        bp.construct_junction_tree(self.maxcliques, self.sizes)
+
+
+    def time_create_junction_tree(self, graph, num_keys, size):
+        jt.create_junction_tree(self.factors, self.sizes)
+
+
+    def peakmem_create_junction_tree(self, graph, num_keys, size):
+        jt.create_junction_tree(self.factors, self.sizes)
+
+
+class Triangulation:
+    """Elimination heuristics"""
+
+    params = (
+        ["min_fill", "weighted_min_fill", "min_degree", "min_weight"],
+        ["grid", "random_bn"],
+    )
+    param_names = ["heuristic", "graph"]
+
+
+    def setup(self, heuristic, graph):
+        (self.factors, self.sizes, _) = graphs[graph](1000, 3)
+
+
+    def time_find_triangulation(self, heuristic, graph):
+        bp.find_triangulation(self.factors, self.sizes, heuristic)
+
+
+    def track_clique_state_size(self, heuristic, graph):
+        (_, _, maxcliques, _) = bp.find_triangulation(
+            self.factors,
+            self.sizes,
+            heuristic
+        )
+        return bp.total_clique_size(maxcliques, self.sizes)
+
+    track_clique_state_size.unit = "states"
+
+
+class Propagation:
+    """Message passing on a compiled Junction tree"""
+
+    params = (list(graphs), [100, 1000], [2, 4])
+    param_names = ["graph", "num_keys", "size"]
+
+
+    def setup(self, graph, num_keys, size):
+        (factors, self.sizes, self.values) = graphs[graph](num_keys, size)
+        self.tree = jt.create_junction_tree(factors, self.sizes)
+
+
+    def time_propagate(self, graph, num_keys, size):
+        self.tree.propagate(self.values)
+
+
+    def peakmem_propagate(self, graph, num_keys, size):
+        self.tree.propagate(self.values)
+
+
+    def time_propagate_log_space(self, graph, num_keys, size):
+        self.tree.propagate(
+            [np.log(value) for value in self.values],
+            distributive_law=bp.log_sum_product
+        )
+
+
+    def peakmem_propagate_tiled(self, graph, num_keys, size):
+        self.tree.propagate(self.values, inplace=True, tile_size=2**20)
+
+
+    def time_propagate_parallel(self, graph, num_keys, size):
+        self.tree.propagate(self.values, workers=4)
+
+
+    def time_eliminate(self, graph, num_keys, size):
+        factor_graph = self.tree.clique_tree.factor_graph
+        factor_graph.eliminate(self.values, factor_graph.factors[-1])
+
+
+    def track_clique_state_size(self, graph, num_keys, size):
+        return bp.total_clique_size(self.tree.clique_tree.maxcliques, self.sizes)
+
+    track_clique_state_size.unit = "states"
+
+
+    def track_max_clique_state_size(self, graph, num_keys, size):
+        return max(
+            bp.state_space_size(clique, self.sizes)
+            for clique in self.tree.clique_tree.maxcliques
+        )
+
+    track_max_clique_state_size.unit = "states"
+
+
+class Hugin:
+    """Recursive (uncompiled) propagation for comparison"""
+
+    params = (list(graphs), [100, 1000], [2, 4])
+    param_names = ["graph", "num_keys", "size"]
+
+
+    def setup(self, graph, num_keys, size):
+        (factors, sizes, values) = graphs[graph](num_keys, size)
+        tree = jt.create_junction_tree(factors, sizes)
+        if np.max(tree.array_tree.depths()) > 200:
+            # collect and distribute recurse once for each level
+            raise NotImplementedError("Tree too deep for recursive propagation")
+        self.tree = tree.tree
+        self.node_list = tree.clique_tree.maxcliques + tree.separators
+        self.potentials = tree.clique_tree.evaluate(values) + [
+            np.ones([sizes[key] for key in separator])
+            for separator in tree.separators
+        ]
+
+
+    def time_hugin(self, graph, num_keys, size):
+        bp.hugin(
+            self.tree,
+            self.node_list,
+            list(self.potentials),
+            bp.sum_product
+        )
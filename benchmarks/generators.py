@@ -0,0 +1,126 @@
+"""
+Synthetic factor graphs for benchmarks
+
+Each generator returns (factors, sizes, values) that can be given directly to
+`create_junction_tree` and `JunctionTree.propagate`. Conditional probability
+tables have the child key last and are normalized over it.
+"""
+
+import numpy as np
+
+
+def random_cpt(shape, rng):
+    """Random conditional probability table normalized over the last axis."""
+    table = rng.random_sample(shape) + 0.01
+    return table / np.sum(table, axis=-1, keepdims=True)
+
+
+def chain(num_keys, size, seed=0):
+    """Markov chain x0 -> x1 -> ... with keys of equal size."""
+
+    rng = np.random.RandomState(seed)
+    keys = ["x%d" % i for i in range(num_keys)]
+    factors = [[keys[0]]] + [
+        [keys[i-1], keys[i]] for i in range(1, num_keys)
+    ]
+    sizes = {key: size for key in keys}
+    values = [
+        random_cpt(tuple(sizes[key] for key in factor), rng)
+        for factor in factors
+    ]
+    return (factors, sizes, values)
+
+
+def grid(num_rows, num_cols, size, seed=0):
+    """Pairwise Markov random field on a grid with unary factors."""
+
+    rng = np.random.RandomState(seed)
+    key = lambda i, j: "x%d_%d" % (i, j)
+    factors = (
+        [[key(i, j)] for i in range(num_rows) for j in range(num_cols)]
+        + [
+            [key(i, j), key(i, j+1)]
+            for i in range(num_rows)
+            for j in range(num_cols-1)
+        ]
+        + [
+            [key(i, j), key(i+1, j)]
+            for i in range(num_rows-1)
+            for j in range(num_cols)
+        ]
+    )
+    sizes = {
+        key(i, j): size
+        for i in range(num_rows)
+        for j in range(num_cols)
+    }
+    values = [
+        rng.random_sample(tuple(sizes[k] for k in factor)) + 0.01
+        for factor in factors
+    ]
+    return (factors, sizes, values)
+
+
+def random_bayesian_network(num_keys, size, max_parents=3, window=6, seed=0):
+    """Random Bayesian network.
+
+    The parents of each key are drawn from the `window` preceding keys so the
+    treewidth stays bounded as the number of keys grows.
+
+    """
+
+    rng = np.random.RandomState(seed)
+    keys = ["x%d" % i for i in range(num_keys)]
+    factors = []
+    for i in range(num_keys):
+        candidates = keys[max(0, i-window):i]
+        num_parents = rng.randint(0, min(max_parents, len(candidates)) + 1)
+        parents = [
+            str(key)
+            for key in rng.choice(candidates, num_parents, replace=False)
+        ] if num_parents else []
+        factors.append(parents + [keys[i]])
+    sizes = {key: size for key in keys}
+    values = [
+        random_cpt(tuple(sizes[key] for key in factor), rng)
+        for factor in factors
+    ]
+    return (factors, sizes, values)
+
+
+def sprinkler(num_copies, seed=0):
+    """The sprinkler network of the README repeated num_copies times.
+
+    Cloudiness of each copy depends on the cloudiness of the previous copy.
+    All keys are binary.
+
+    """
+
+    rng = np.random.RandomState(seed)
+    factors = []
+    for i in range(num_copies):
+        (cloudy, sprinkler, rain, wet_grass) = [
+            "%s%d" % (name, i)
+            for name in ("cloudy", "sprinkler", "rain", "wet_grass")
+        ]
+        factors += [
+            [cloudy] if i == 0 else ["cloudy%d" % (i-1), cloudy],
+            [cloudy, sprinkler],
+            [cloudy, rain],
+            [rain, sprinkler, wet_grass],
+        ]
+    sizes = {key: 2 for factor in factors for key in factor}
+    values = [
+        random_cpt(tuple(sizes[key] for key in factor), rng)
+        for factor in factors
+    ]
+    return (factors, sizes, values)
+
+
+# Generators by number of keys and key size
+graphs = {
+    "chain": lambda n, size: chain(n, size),
+    "grid": lambda n, size: grid(5, n // 5, size),
+    "random_bn": lambda n, size: random_bayesian_network(n, size),
+    "sprinkler": lambda n, size: sprinkler(n // 4),
+}
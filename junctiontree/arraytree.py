@@ -0,0 +1,279 @@
+"""
+Array-backed representation of Junction trees
+
+The nested tree structure
+
+    [clique_ix, (separator_ix, child_tree), ...]
+
+is convenient to write by hand but copying and traversing it is slow for large
+trees. ArrayTree stores the same information in flat integer arrays indexed by
+clique ID so that traversals, re-rooting and serialization are simple array
+operations.
+"""
+
+import numpy as np
+import attr
+
+
+# Integer type of the index arrays
+INDEX_DTYPE = np.int32
+
+
+@attr.s(frozen=True, eq=False)
+class ArrayTree():
+    """
+    Junction tree as flat index arrays.
+
+    Separator IDs are the node IDs used in the nested tree structure, that
+    is, they point to the node list `maxcliques + separators`.
+    """
+
+    # Parent clique of each clique (-1 for the root)
+    parents = attr.ib()
+
+    # Separator between each clique and its parent (-1 for the root)
+    separators = attr.ib()
+
+    # Children of clique i are children[child_offsets[i]:child_offsets[i+1]]
+    child_offsets = attr.ib()
+    children = attr.ib()
+
+    # Cliques in depth-first pre-order (parents before their children)
+    order = attr.ib()
+
+    # Distance of each clique from the root (computed once)
+    _depths = attr.ib(init=False, eq=False, repr=False)
+
+
+    @_depths.default
+    def _compute_depths(self):
+        depths = np.zeros(len(self.parents), dtype=INDEX_DTYPE)
+        # parents are before children in pre-order
+        for c_ix in self.order[1:]:
+            depths[c_ix] = depths[self.parents[c_ix]] + 1
+        return depths
+
+
+    @property
+    def root(self):
+        return int(self.order[0])
+
+
+    def get_children(self, clique_ix):
+        """Child cliques of a clique."""
+        return self.children[
+            self.child_offsets[clique_ix]:self.child_offsets[clique_ix+1]
+        ]
+
+
+    def depths(self):
+        """Distance of each clique from the root."""
+        return self._depths.copy()
+
+
+    def path(self, clique1_ix, clique2_ix):
+        """Cliques on the path from clique1 to clique2 (both included)."""
+        depths = self._depths
+        (up, down) = ([clique1_ix], [clique2_ix])
+        while up[-1] != down[-1]:
+            if depths[up[-1]] >= depths[down[-1]]:
+                up.append(int(self.parents[up[-1]]))
+            else:
+                down.append(int(self.parents[down[-1]]))
+        return up + down[-2::-1]
+
+
+    def reroot(self, clique_ix):
+        """Return the same tree with the given clique as the root."""
+
+        parents = self.parents.copy()
+        separators = self.separators.copy()
+
+        # reverse the edges on the path from the new root to the old root
+        (child, parent, sep) = (clique_ix, -1, -1)
+        while child != -1:
+            (next_child, next_sep) = (int(parents[child]), int(separators[child]))
+            parents[child] = parent
+            separators[child] = sep
+            (child, parent, sep) = (next_child, child, next_sep)
+
+        return ArrayTree.from_parents(parents, separators)
+
+
+    def to_tree(self):
+        """Convert to the nested tree structure."""
+        trees = [[int(c_ix)] for c_ix in range(len(self.parents))]
+        # children are appended in order because parents precede children
+        for c_ix in self.order[1:]:
+            trees[self.parents[c_ix]].append(
+                (int(self.separators[c_ix]), trees[c_ix])
+            )
+        return trees[self.root]
+
+
+    def to_arrays(self):
+        """Dictionary of the arrays (e.g., for numpy.savez)."""
+        return {
+            "parents": self.parents,
+            "separators": self.separators,
+            "child_offsets": self.child_offsets,
+            "children": self.children,
+            "order": self.order,
+        }
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Inverse of to_arrays."""
+        return cls(
+            **{
+                name: np.asarray(arrays[name], dtype=INDEX_DTYPE)
+                for name in (
+                    "parents",
+                    "separators",
+                    "child_offsets",
+                    "children",
+                    "order",
+                )
+            }
+        )
+
+
+    @classmethod
+    def from_parents(cls, parents, separators):
+        """Create tree from parent and separator arrays.
+
+        Children of each clique are ordered by their IDs.
+
+        """
+
+        parents = np.asarray(parents, dtype=INDEX_DTYPE)
+        separators = np.asarray(separators, dtype=INDEX_DTYPE)
+        num_cliques = len(parents)
+
+        # children grouped by parent (compressed sparse row format)
+        non_roots = np.flatnonzero(parents >= 0)
+        children = non_roots[
+            np.argsort(parents[non_roots], kind="stable")
+        ].astype(INDEX_DTYPE)
+        child_offsets = np.concatenate(
+            [
+                [0],
+                np.cumsum(np.bincount(parents[non_roots], minlength=num_cliques))
+            ]
+        ).astype(INDEX_DTYPE)
+
+        roots = np.flatnonzero(parents < 0)
+        if len(roots) != 1:
+            raise ValueError("Tree must have exactly one root")
+
+        # depth-first pre-order
+        order = np.empty(num_cliques, dtype=INDEX_DTYPE)
+        stack = [int(roots[0])]
+        i = 0
+        while stack:
+            c_ix = stack.pop()
+            order[i] = c_ix
+            i += 1
+            stack.extend(
+                children[child_offsets[c_ix]:child_offsets[c_ix+1]][::-1].tolist()
+            )
+        if i != num_cliques:
+            raise ValueError("Tree is not connected")
+
+        return cls(
+            parents=parents,
+            separators=separators,
+            child_offsets=child_offsets,
+            children=children,
+            order=order,
+        )
+
+
+    @classmethod
+    def from_edges(cls, num_cliques, edges, root=0):
+        """Create tree from a list of edges.
+
+        Each edge is a (clique1 ID, clique2 ID, ...) tuple and the separator
+        ID of an edge is the number of cliques plus the position of the edge
+        in the list.
+
+        """
+
+        edges = np.array(
+            [(c_ix1, c_ix2) for (c_ix1, c_ix2, *_) in edges],
+            dtype=INDEX_DTYPE
+        ).reshape((-1, 2))
+        sep_ixs = num_cliques + np.arange(len(edges), dtype=INDEX_DTYPE)
+
+        # undirected adjacency in compressed sparse row format
+        sources = np.concatenate([edges[:,0], edges[:,1]])
+        targets = np.concatenate([edges[:,1], edges[:,0]])
+        seps = np.concatenate([sep_ixs, sep_ixs])
+        ind = np.argsort(sources, kind="stable")
+        (targets, seps) = (targets[ind], seps[ind])
+        offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(sources, minlength=num_cliques))]
+        )
+
+        parents = np.full(num_cliques, -1, dtype=INDEX_DTYPE)
+        separators = np.full(num_cliques, -1, dtype=INDEX_DTYPE)
+        visited = np.zeros(num_cliques, dtype=bool)
+        visited[root] = True
+        stack = [root]
+        while stack:
+            c_ix = stack.pop()
+            for j in range(offsets[c_ix], offsets[c_ix+1]):
+                n_ix = targets[j]
+                if not visited[n_ix]:
+                    visited[n_ix] = True
+                    parents[n_ix] = c_ix
+                    separators[n_ix] = seps[j]
+                    stack.append(n_ix)
+
+        return cls.from_parents(parents, separators)
+
+
+    @classmethod
+    def from_tree(cls, tree, num_cliques=None):
+        """Create from the nested tree structure.
+
+        The order of the children is kept.
+
+        """
+
+        parents = {}
+        separators = {}
+        order = []
+        stack = [(tree, -1, -1)]
+        while stack:
+            (t, parent, sep) = stack.pop()
+            parents[t[0]] = parent
+            separators[t[0]] = sep
+            order.append(t[0])
+            stack.extend([(child, t[0], sep_ix) for (sep_ix, child) in reversed(t[1:])])
+
+        num_cliques = len(order) if num_cliques is None else num_cliques
+        parents = np.array([parents[c_ix] for c_ix in range(num_cliques)], dtype=INDEX_DTYPE)
+        separators = np.array([separators[c_ix] for c_ix in range(num_cliques)], dtype=INDEX_DTYPE)
+        order = np.array(order, dtype=INDEX_DTYPE)
+
+        # children in the same order as in the nested structure
+        non_roots = order[parents[order] >= 0]
+        children = non_roots[
+            np.argsort(parents[non_roots], kind="stable")
+        ].astype(INDEX_DTYPE)
+        child_offsets = np.concatenate(
+            [
+                [0],
+                np.cumsum(np.bincount(parents[non_roots], minlength=num_cliques))
+            ]
+        ).astype(INDEX_DTYPE)
+
+        return cls(
+            parents=parents,
+            separators=separators,
+            child_offsets=child_offsets,
+            children=children,
+            order=order,
+        )
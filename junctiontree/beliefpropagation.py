@@ -28,7 +28,9 @@ import copy
 
 # FIXME: Cyclic import
 
-from .sum_product import SumProduct
+from .sum_product import SumProduct, LogSumProduct, MaxProduct, compile_alignment, tile_slices
+from . import sum_product as sp
+from .arraytree import ArrayTree
 
 
 def factors_to_undirected_graph(factors):
@@ -58,11 +60,154 @@ def factors_to_undirected_graph(factors):
     return edges
 
 
-def find_triangulation(factors, key_sizes):
+def min_fill(key, neighbors, fill_edges, key_sizes):
+    """
+    Min-fill heuristic: number of edges added by eliminating key (ties
+        broken by the weight of the induced cluster)
+
+    Input:
+    ------
+
+    Key to be scored
+
+    List of remaining neighbors of the key
+
+    List of edges (key pairs) added if key is eliminated
+
+    Dictionary of key sizes
+
+    Output:
+    -------
+
+    Tuple of primary score and tie-breaker (smaller is better)
+
+    """
+    return (len(fill_edges), cluster_weight(key, neighbors, key_sizes))
+
+
+def weighted_min_fill(key, neighbors, fill_edges, key_sizes):
+    """
+    Weighted min-fill heuristic: sum of the weights (product of the key
+        sizes) of the edges added by eliminating key
+
+    See min_fill for inputs and output
+    """
+    return (
+        sum([key_sizes[n1]*key_sizes[n2] for (n1, n2) in fill_edges]),
+        cluster_weight(key, neighbors, key_sizes)
+    )
+
+
+def min_degree(key, neighbors, fill_edges, key_sizes):
+    """
+    Min-degree (min-width) heuristic: number of remaining neighbors of key
+
+    See min_fill for inputs and output
+    """
+    return (len(neighbors), cluster_weight(key, neighbors, key_sizes))
+
+
+def min_weight(key, neighbors, fill_edges, key_sizes):
+    """
+    Min-weight heuristic: state space size of the induced cluster
+
+    See min_fill for inputs and output
+    """
+    return (cluster_weight(key, neighbors, key_sizes), len(fill_edges))
+
+
+# Elimination heuristics selectable by name
+heuristics = {
+    "min_fill": min_fill,
+    "weighted_min_fill": weighted_min_fill,
+    "min_degree": min_degree,
+    "min_weight": min_weight,
+}
+
+
+class RandomRestarts():
+    """
+    Randomized restart variant of an elimination heuristic
+
+    The triangulation is run several times with ties of the heuristic
+        broken randomly, and the triangulation with the smallest total
+        clique state space is kept. The first run uses the deterministic
+        heuristic so the result is never worse than that.
+    """
+
+    def __init__(self, heuristic="min_fill", restarts=10, seed=None):
+        self.heuristic = get_heuristic(heuristic)
+        self.restarts = restarts
+        self.seed = seed
+
+    def heuristics(self):
+        """Yield the heuristics used in each of the restarts"""
+
+        rng = np.random.RandomState(self.seed)
+
+        def __randomized(key, neighbors, fill_edges, key_sizes):
+            (score, tie_breaker) = self.heuristic(key, neighbors, fill_edges, key_sizes)
+            return (score, (tie_breaker, rng.random_sample()))
+
+        yield self.heuristic
+        for _ in range(self.restarts - 1):
+            yield __randomized
+
+
+def get_heuristic(heuristic):
+    """
+    Return elimination heuristic given as a name, a scoring function or a
+        RandomRestarts instance
+
+    A name "random_restarts" gives RandomRestarts with default settings
+    """
+
+    if heuristic == "random_restarts":
+        return RandomRestarts()
+    if isinstance(heuristic, str):
+        try:
+            return heuristics[heuristic]
+        except KeyError:
+            raise ValueError(
+                "Unknown heuristic {0}. Available heuristics: {1}".format(
+                    heuristic,
+                    ", ".join(sorted(heuristics) + ["random_restarts"])
+                )
+            )
+    return heuristic
+
+
+def cluster_weight(key, neighbors, key_sizes):
+    """
+    Weight of a cluster: the product of all key sizes in the cluster
+        formed by key and its neighbors
+    """
+    return state_space_size([key] + list(neighbors), key_sizes)
+
+
+def state_space_size(keys, key_sizes):
+    """
+    Number of states of the given keys (product of key sizes)
+    """
+    # use Python integers which don't overflow for large clusters
+    size = 1
+    for key in keys:
+        size *= key_sizes[key]
+    return size
+
+
+def total_clique_size(cliques, key_sizes):
+    """
+    Total state space size of cliques (sum of products of key sizes)
+    """
+    return sum([state_space_size(clique, key_sizes) for clique in cliques])
+
+
+def find_triangulation(factors, key_sizes, heuristic="min_fill"):
     """
     Triangulate given factor graph.
 
-    TODO: Provide different algorithms.
+    The elimination order is determined greedily by the given heuristic.
 
     Inputs:
     -------
@@ -80,6 +225,11 @@ def find_triangulation(factors, key_sizes):
         keyM: sizeM
     }
 
+    Elimination heuristic: a name in heuristics dictionary ("min_fill",
+        "weighted_min_fill", "min_degree" or "min_weight"),
+        "random_restarts", a RandomRestarts instance or a function with the
+        same signature as min_fill
+
     Output:
     -------
 
@@ -93,31 +243,31 @@ def find_triangulation(factors, key_sizes):
 
     """
 
+    heuristic = get_heuristic(heuristic)
+    if isinstance(heuristic, RandomRestarts):
+        # keep the triangulation with the smallest total clique state space
+        return min(
+            [
+                find_triangulation(factors, key_sizes, h)
+                for h in heuristic.heuristics()
+            ],
+            key=lambda t: total_clique_size(t[2], key_sizes)
+        )
+
     # NOTE: Only keys that have been used at least in one factor should be
     # used. Ignore those key sizes that are not in any factor. Perhaps this
     # could be fixed elsewhere. Just added a quick fix here to filter key
     # sizes.
-    used_keys = list(
-        set(key for factor in factors for key in factor)
-    )
+    used_keys = set(key for factor in factors for key in factor)
     key_sizes = {
         key: size
         for (key, size) in key_sizes.items()
         if key in used_keys
     }
 
+    adjacency = factors_to_adjacency(factors)
 
-    tri = []
-    induced_clusters = []
-    induced_cluster_to_maxclique = {}
-    max_cliques = []
-    # assign factor to maxclique which is either
-    # the factor itself or a factor which it is a subset of
-
-
-    edges = factors_to_undirected_graph(factors)
-
-    if len(edges) == 0:
+    if all(len(neighbors) == 0 for neighbors in adjacency.values()):
         # no edges present in factor graph
         return (
                 [],
@@ -126,95 +276,330 @@ def find_triangulation(factors, key_sizes):
                 range(len(factors))
         )
 
+    (ordering, tri) = find_elimination_ordering(
+                                            key_sizes,
+                                            adjacency,
+                                            heuristic
+    )
+
+    rank = key_ranks(key_sizes.keys())
+    induced_clusters = []
+    induced_cluster_to_maxclique = []
+    max_cliques = []
+    # indices of induced clusters containing each key
+    key_to_clusters = {}
+
+    for (key, rem_neighbors) in ordering:
+        new_clust = rem_neighbors + [key]
+        new_clust_set = frozenset(new_clust)
+
+        # a cluster which is not a maximal clique is a subset of some earlier
+        # cluster, and such a cluster must contain the eliminated key
+        maxclique_ix = next(
+            (
+                induced_cluster_to_maxclique[ic_ix]
+                for ic_ix in key_to_clusters.get(key, [])
+                if new_clust_set < frozenset(induced_clusters[ic_ix])
+            ),
+            None
+        )
+
+        if maxclique_ix is None:
+            # new maxclique discovered
+            max_cliques.append(sorted(new_clust, key=rank.get))
+            maxclique_ix = len(max_cliques) - 1
 
-    factor_to_maxclique = [None]*len(factors)
-    subsets = {}
-    for ix, f1 in enumerate(factors):
-        subset_of_ix = max(
-                enumerate(
-                    [
-                        -1 if not set(f1) <= set(f2) else len(set(f2) - set(f1))
-                        for f2 in factors
-                    ]
-                ),
-                key=lambda t: t[1]
-        )[0]
-        subsets.setdefault(subset_of_ix, []).append(ix)
+        for k in new_clust:
+            key_to_clusters.setdefault(k, []).append(len(induced_clusters))
+        induced_clusters.append(new_clust)
+        induced_cluster_to_maxclique.append(maxclique_ix)
+
+    # assign each factor to the maxclique of the cluster of its first
+    # eliminated key (all other keys of the factor are in that cluster)
+    position = {key: i for (i, (key, _)) in enumerate(ordering)}
+    factor_to_maxclique = [
+        induced_cluster_to_maxclique[
+            min([position[key] for key in factor])
+        ] if len(factor) > 0 else 0
+        for factor in factors
+    ]
 
+    return tri, induced_clusters, max_cliques, factor_to_maxclique
 
-    edges = factors_to_undirected_graph(factors)
 
-    heap, entry_finder = initialize_triangulation_heap(
-                                            key_sizes,
-                                            edges
+def estimate_cost(factors, key_sizes, heuristic="min_fill", itemsize=8):
+    """
+    Estimate the size and propagation cost of a Junction tree without
+        creating it
+
+    Only the elimination ordering of find_triangulation is computed. The
+        maximal cliques and the tree edges are then found from the ordering
+        in linear time: the cluster of a key (the key and its remaining
+        neighbors at elimination) is contained in the cluster of an earlier
+        key if the key is the follower (first eliminated remaining neighbor)
+        of the earlier key and the earlier cluster is larger by one.
+        Otherwise it is a new maximal clique. A key whose follower belongs
+        to another maximal clique gives a tree edge with the remaining
+        neighbors of the key as the separator.
+
+    Input:
+    ------
+
+    List of factors (lists of keys)
+
+    Dictionary of key sizes
+
+    Elimination heuristic (see find_triangulation)
+
+    (Optional) Number of bytes of a potential value (8 for float64)
+
+    Output:
+    -------
+
+    Dictionary of:
+
+        treewidth: number of keys in the largest maximal clique minus one
+
+        num_cliques: number of maximal cliques
+
+        max_clique_size: state space size of the largest maximal clique
+
+        clique_size: total state space size of the maximal cliques
+
+        separator_size: total state space size of the separators
+
+        memory: bytes of the clique and separator potentials
+
+        flops: estimated number of arithmetic operations in one propagation
+            (clique evaluation, Hugin messages and marginalization to
+            factors)
+
+    """
+
+    heuristic = get_heuristic(heuristic)
+    if isinstance(heuristic, RandomRestarts):
+        # keep the smallest total clique state space as find_triangulation
+        return min(
+            [
+                estimate_cost(factors, key_sizes, h, itemsize)
+                for h in heuristic.heuristics()
+            ],
+            key=lambda cost: cost["clique_size"]
+        )
+
+    used_keys = set(key for factor in factors for key in factor)
+    key_sizes = {
+        key: size
+        for (key, size) in key_sizes.items()
+        if key in used_keys
+    }
+    (ordering, _) = find_elimination_ordering(
+                                        key_sizes,
+                                        factors_to_adjacency(factors),
+                                        heuristic
     )
+    position = {key: i for (i, (key, _)) in enumerate(ordering)}
+    followers = {
+        key: min(rem_neighbors, key=position.get)
+        for (key, rem_neighbors) in ordering
+        if rem_neighbors
+    }
 
-    rem_keys = list(key_sizes.keys())
-    while len(rem_keys) > 0:
-        item, heap, entry_finder, rem_keys = remove_next(
-                                                        heap,
-                                                        entry_finder,
-                                                        rem_keys,
-                                                        key_sizes,
-                                                        edges
+    # maximal clique containing the cluster of each key and the number of
+    # keys and states in each maximal clique
+    clique_of = {}
+    cliques = []
+    for (key, rem_neighbors) in ordering:
+        if key not in clique_of:
+            clique_of[key] = len(cliques)
+            cliques.append(
+                (
+                    len(rem_neighbors) + 1,
+                    state_space_size([key] + rem_neighbors, key_sizes)
+                )
+            )
+        follower = followers.get(key)
+        if (
+                follower is not None and
+                len(rem_neighbors) == len(ordering[position[follower]][1]) + 1
+        ):
+            clique_of.setdefault(follower, clique_of[key])
+
+    # tree edges as (clique, clique, separator size)
+    edges = [
+        (
+            clique_of[key],
+            clique_of[followers[key]],
+            state_space_size(rem_neighbors, key_sizes)
         )
-        key = item[2]
-        # find neighbors that are in remaining keys
-        rem_neighbors = []
-        origin_factors = []
-        for edge, factor_ix in edges.items():
-            if key in edge:
-                neighbor = set(rem_keys).intersection(edge)
-                if len(neighbor) == 1:
-                    rem_neighbors.append(neighbor.pop())
-                    if factor_ix != None and factor_to_maxclique[factor_ix] == None:
-                        origin_factors.extend(
-                                                sum(
-                                                    [[factor_ix]],
-                                                    [
-                                                        sub_factor_ix
-                                                        for sub_factor_ix in subsets.get(factor_ix, [])
-                                                    ]
-                                                )
-                        )
+        for (key, rem_neighbors) in ordering
+        if key in followers and clique_of[key] != clique_of[followers[key]]
+    ]
+    # disconnected parts of the graph are joined with empty separators
+    separator_sizes = (
+        [size for (_, _, size) in edges] +
+        (len(cliques) - 1 - len(edges)) * [1]
+    )
 
-        new_clust = rem_neighbors + [key]
-        # connect all unconnected neighbors of key
-        for i, n1 in enumerate(rem_neighbors):
-            for n2 in rem_neighbors[i+1:]:
-                if frozenset((n1,n2)) not in edges:
-                    edges[frozenset((n1,n2))] = None
-                    tri.append((n1,n2))
+    clique_sizes = [size for (_, size) in cliques]
+    factor_clique_sizes = [
+        clique_sizes[clique_of[min(factor, key=position.get)]]
+        for factor in factors
+        if len(factor) > 0
+    ]
+    flops = (
+        # multiplying factors into cliques and marginalizing back
+        2 * sum(factor_clique_sizes) +
+        # projection and absorption in both directions of each edge
+        sum(
+            2 * (clique_sizes[c1] + clique_sizes[c2]) + 2 * size
+            for (c1, c2, size) in edges
+        )
+    )
 
-        new_ic_ix = len(induced_clusters)
+    return {
+        "treewidth": max([n for (n, _) in cliques], default=1) - 1,
+        "num_cliques": len(cliques),
+        "max_clique_size": max(clique_sizes, default=1),
+        "clique_size": sum(clique_sizes),
+        "separator_size": sum(separator_sizes),
+        "memory": itemsize * (sum(clique_sizes) + sum(separator_sizes)),
+        "flops": flops,
+    }
 
-        for ic_ix, s2 in enumerate(induced_clusters):
-            if frozenset(new_clust) < frozenset(s2):
-                # new cluster is just subset of existing cluster
-                induced_cluster_to_maxclique[new_ic_ix] = induced_cluster_to_maxclique[ic_ix]
 
-                # map factors to existing maxclique
-                for factor_ix in set(origin_factors):
-                    factor_to_maxclique[factor_ix] = induced_cluster_to_maxclique[new_ic_ix]
+def factors_to_adjacency(factors):
+    """
+    Represent factor graph as undirected graph in adjacency set form
 
-                break
+    Input:
+    ------
 
-        induced_clusters.append(new_clust)
+    List of factors
 
-        if new_ic_ix not in induced_cluster_to_maxclique:
-            # new maxclique discovered
-            max_cliques.append(sorted(new_clust))
-            new_maxclique_ix = len(max_cliques) - 1
-            induced_cluster_to_maxclique[new_ic_ix] = new_maxclique_ix
-            # map factors to new maxclique
-            for factor_ix in list(set(origin_factors)):
-                factor_to_maxclique[factor_ix] = new_maxclique_ix
+    Output:
+    -------
 
+    Dictionary mapping each key to the set of its neighboring keys
 
-    return tri, induced_clusters, max_cliques, factor_to_maxclique
+    """
+
+    adjacency = {}
+
+    for factor in factors:
+        for key in factor:
+            adjacency.setdefault(key, set()).update(factor)
+
+    for (key, neighbors) in adjacency.items():
+        neighbors.discard(key)
+
+    return adjacency
+
+
+def key_ranks(keys):
+    """
+    Map keys to their positions in sorted order
+
+    Used for deterministic tie-breaking and ordering of keys. If the keys
+        are not comparable with each other, the given order is used.
+    """
+
+    keys = list(keys)
+    try:
+        keys = sorted(keys)
+    except TypeError:
+        pass
+    return {key: i for (i, key) in enumerate(keys)}
+
+
+def find_elimination_ordering(key_sizes, adjacency, heuristic=min_fill):
+    """
+    Find elimination ordering greedily by using the given heuristic
+
+    The graph is kept in adjacency set form. After a key is eliminated,
+        only the keys whose neighborhood changed are rescored: the
+        neighbors of the eliminated key and the keys adjacent to both ends
+        of an added edge. Thus, the heuristic must depend only on the
+        neighborhood of the scored key (see min_fill).
+
+    Input:
+    ------
+
+    Dictionary of key sizes
+
+    Dictionary mapping each key to the set of its neighbors (not modified)
+
+    (Optional) Elimination heuristic
+
+    Output:
+    -------
+
+    List of (key, remaining neighbors of key) pairs in elimination order
+
+    List of edges added to triangulate the graph
+
+    """
+
+    heuristic = get_heuristic(heuristic)
+    adjacency = {
+        key: set(adjacency.get(key, ()))
+        for key in key_sizes
+    }
+    rank = key_ranks(key_sizes.keys())
+
+    def __entry(key):
+        neighbors = sorted(adjacency[key], key=rank.get)
+        fill_edges = [
+                        (n1, n2)
+                        for (i, n1) in enumerate(neighbors)
+                            for n2 in neighbors[i+1:]
+                                if n2 not in adjacency[n1]
+        ]
+        # ties are broken by key rank so that keys need not be comparable
+        return list(heuristic(key, neighbors, fill_edges, key_sizes)) + [rank[key], key]
+
+    entry_finder = {key: __entry(key) for key in adjacency}
+    heap = list(entry_finder.values())
+    heapq.heapify(heap)
+
+    ordering = []
+    tri = []
+    while entry_finder:
+        entry = heapq.heappop(heap)
+        key = entry[-1]
+        if entry_finder.get(key) is not entry:
+            # outdated entry
+            continue
+        del entry_finder[key]
+
+        rem_neighbors = sorted(adjacency.pop(key), key=rank.get)
+        for n in rem_neighbors:
+            adjacency[n].discard(key)
+
+        # connect all unconnected neighbors of key
+        fill_edges = []
+        for (i, n1) in enumerate(rem_neighbors):
+            for n2 in rem_neighbors[i+1:]:
+                if n2 not in adjacency[n1]:
+                    adjacency[n1].add(n2)
+                    adjacency[n2].add(n1)
+                    fill_edges.append((n1, n2))
+
+        ordering.append((key, rem_neighbors))
+        tri.extend(fill_edges)
+
+        # rescore keys whose neighborhood changed
+        changed = set(rem_neighbors).union(
+            *[adjacency[n1] & adjacency[n2] for (n1, n2) in fill_edges]
+        )
+        for k in changed:
+            entry_finder[k] = __entry(k)
+            heapq.heappush(heap, entry_finder[k])
+
+    return ordering, tri
 
 
-def initialize_triangulation_heap(key_sizes, edges):
+def initialize_triangulation_heap(key_sizes, edges, heuristic=min_fill):
     """
     Creates heap used for graph triangulation
 
@@ -225,6 +610,8 @@ def initialize_triangulation_heap(key_sizes, edges):
 
      A list of pairs of keys representing factor graph edges
 
+    (Optional) Elimination heuristic used to score keys (see min_fill)
+
 
     Output:
     -------
@@ -236,16 +623,24 @@ def initialize_triangulation_heap(key_sizes, edges):
         tuple (key associated with first two elements, factor key added to
     ]
 
+    (first two elements are given by the heuristic, the above applies to
+        the default min_fill heuristic)
+
     A dictionary with key label as key and reference
         to heap entry for key
     """
 
-    heap, entry_finder = update_heap(key_sizes.keys(), edges, key_sizes)
+    heap, entry_finder = update_heap(
+                                key_sizes.keys(),
+                                edges,
+                                key_sizes,
+                                heuristic=heuristic
+    )
 
     return heap, entry_finder
 
 
-def update_heap(remaining_keys, edges, key_sizes, heap=None, entry_finder=None):
+def update_heap(remaining_keys, edges, key_sizes, heap=None, entry_finder=None, heuristic=min_fill):
     """
     Updates entries in heap
 
@@ -262,6 +657,8 @@ def update_heap(remaining_keys, edges, key_sizes, heap=None, entry_finder=None):
 
     entry_finder dictionary with references to heap elements
 
+    elimination heuristic used to score keys (see min_fill)
+
     Output:
     -------
 
@@ -276,18 +673,14 @@ def update_heap(remaining_keys, edges, key_sizes, heap=None, entry_finder=None):
         rem_neighbors = [(set(edge) - set(key)).pop()
                             for edge in edges if key in edge and len(set(remaining_keys).intersection(edge)) == 2]
 
-        # determine how many of key's remaining neighbors need to be connected
-        num_new_edges = sum(
-                            [
-                                frozenset((n1,n2)) not in edges
-                                for i, n1 in enumerate(rem_neighbors)
-                                    for n2 in rem_neighbors[i+1:]
-
-                            ]
-        )
-        # weight of a cluster is the product of all key lengths in cluster
-        weight = key_sizes[key]*np.prod([key_sizes[n] for n in rem_neighbors])
-        entry = [num_new_edges, weight, key]
+        # determine which of key's remaining neighbors need to be connected
+        fill_edges = [
+                        (n1,n2)
+                        for i, n1 in enumerate(rem_neighbors)
+                            for n2 in rem_neighbors[i+1:]
+                                if frozenset((n1,n2)) not in edges
+        ]
+        entry = list(heuristic(key, rem_neighbors, fill_edges, key_sizes)) + [key]
         heapq.heappush(h, entry)
         # invalidate previous entry if it exists
         prev = entry_finder.get(key, None)
@@ -299,7 +692,7 @@ def update_heap(remaining_keys, edges, key_sizes, heap=None, entry_finder=None):
     return h, entry_finder
 
 
-def remove_next(heap, entry_finder, remaining_keys, key_sizes, edges):
+def remove_next(heap, entry_finder, remaining_keys, key_sizes, edges, heuristic=min_fill):
     """
     Removes next entry from heap
 
@@ -316,6 +709,8 @@ def remove_next(heap, entry_finder, remaining_keys, key_sizes, edges):
 
     list of edge pairs in original graph G
 
+    elimination heuristic used to score keys (see min_fill)
+
     Output:
     -------
 
@@ -345,7 +740,8 @@ def remove_next(heap, entry_finder, remaining_keys, key_sizes, edges):
                                 edges,
                                 key_sizes,
                                 heap,
-                                entry_finder
+                                entry_finder,
+                                heuristic
     )
 
 
@@ -397,6 +793,12 @@ def construct_junction_tree(cliques, key_sizes):
     """
     Construct junction tree from input cliques
 
+    The tree is a maximum weight spanning tree of the cliques where the
+        weight of an edge is the size of the separator (ties broken by
+        preferring cliques with smaller state spaces). It is found with
+        Kruskal's algorithm by considering only pairs of cliques sharing at
+        least one key.
+
     Input:
     ------
 
@@ -416,53 +818,126 @@ def construct_junction_tree(cliques, key_sizes):
 
     """
 
-    #trees = [[c_ix, clique] for c_ix, clique in enumerate(cliques)]
-    trees = [[c_ix] for c_ix, clique in enumerate(cliques)]
-    # set of candidate sepsets
-    sepsets = list()
-    for i, X in enumerate(cliques):
-        for j, Y in enumerate(cliques[i+1:]):
-            sepset = tuple(set(X).intersection(Y))
-            sepsets.append((sepset, (i,j+i+1)))
+    edges = find_junction_tree_edges(cliques, key_sizes)
+    tree = edges_to_tree(len(cliques), edges)
+    return tree, [sepset for (_, _, sepset) in edges]
 
-    separator_dict = {}
 
-    heap = build_sepset_heap(sepsets, cliques, key_sizes)
-    num_selected = 0
+def find_junction_tree_edges(cliques, key_sizes):
+    """
+    Find the edges of junction tree by using union-find and Kruskal's
+        algorithm
 
-    while num_selected < len(cliques) - 1:
-        entry = heapq.heappop(heap)
-        ss_ix = entry[2]
-        (cliq1_ix, cliq2_ix) = sepsets[ss_ix][1]
-
-        tree1, tree2 = None, None
-        for tree in trees:
-            # find tree (tree1) containing cliq1_ix
-            tree1 = tree1 if tree1 else (tree if find_subtree(tree,cliq1_ix) != [] else None)
-            # find tree (tree2) containing cliq2_ix
-            tree2 = tree2 if tree2 else (tree if find_subtree(tree,cliq2_ix) != [] else None)
-
-        if tree1 != tree2:
-            ss_tree_ix = len(cliques) + num_selected
-            # merge tree1 and tree2 into new_tree
-            new_tree = merge_trees(
-                                tree1,
-                                cliq1_ix,
-                                tree2,
-                                cliq2_ix,
-                                ss_tree_ix
+    Input:
+    ------
+
+    A list of maximal cliques where each maximal clique is a list of
+        key indices it contains
+
+    A dictionary of (key label, key size) pairs
+
+    Output:
+    -------
+
+    A list of edges (clique1 ID, clique2 ID, separator keys) of the tree.
+        Separator ID of an edge is the number of cliques plus the
+        position of the edge in the list
+
+    """
+
+    weights = [state_space_size(clique, key_sizes) for clique in cliques]
+
+    # inverted index from key to cliques containing the key, used to count
+    # the number of keys shared by each pair of cliques
+    key_to_cliques = {}
+    for (c_ix, clique) in enumerate(cliques):
+        for key in clique:
+            key_to_cliques.setdefault(key, []).append(c_ix)
+
+    shared_counts = {}
+    for c_ixs in key_to_cliques.values():
+        for (i, c_ix1) in enumerate(c_ixs):
+            for c_ix2 in c_ixs[i+1:]:
+                pair = (c_ix1, c_ix2)
+                shared_counts[pair] = shared_counts.get(pair, 0) + 1
+
+    candidates = sorted(
+        shared_counts.items(),
+        key=lambda item: (
+            -item[1],
+            weights[item[0][0]] + weights[item[0][1]],
+            item[0]
+        )
+    )
+
+    # union-find forest of cliques
+    parents = list(range(len(cliques)))
+
+    def __find(ix):
+        while parents[ix] != ix:
+            # path halving
+            parents[ix] = parents[parents[ix]]
+            ix = parents[ix]
+        return ix
+
+    edges = []
+    for ((c_ix1, c_ix2), _) in candidates:
+        root1 = __find(c_ix1)
+        root2 = __find(c_ix2)
+        if root1 != root2:
+            parents[root2] = root1
+            clique2 = set(cliques[c_ix2])
+            edges.append(
+                (
+                    c_ix1,
+                    c_ix2,
+                    [key for key in cliques[c_ix1] if key in clique2]
+                )
             )
-            separator_dict[ss_tree_ix] = sepsets[ss_ix][0]
-            # insert new_tree into forest
-            trees.append(new_tree)
 
-            # remove tree1 and tree2 from forest
-            trees.remove(tree1)
-            trees.remove(tree2)
-            num_selected += 1
+    # join unconnected trees with empty separators by connecting the
+    # smallest clique of each tree to the smallest clique overall
+    smallest = {}
+    for c_ix in range(len(cliques)):
+        root = __find(c_ix)
+        if root not in smallest or weights[c_ix] < weights[smallest[root]]:
+            smallest[root] = c_ix
+    if len(smallest) > 1:
+        hub = min(smallest.values(), key=lambda c_ix: (weights[c_ix], c_ix))
+        edges.extend(
+            [
+                (hub, c_ix, [])
+                for c_ix in sorted(smallest.values())
+                if c_ix != hub
+            ]
+        )
+
+    return edges
+
+
+def edges_to_tree(num_cliques, edges, root=0):
+    """
+    Convert junction tree edges to the nested tree structure
+
+    Input:
+    ------
 
-    # trees list contains one tree which is the fully constructed tree
-    return trees[0], [list(separator_dict[ix]) for ix in sorted(separator_dict.keys())]
+    Number of cliques
+
+    A list of edges (clique1 ID, clique2 ID, separator keys). Separator ID of
+        an edge is the number of cliques plus the position of the edge in the
+        list
+
+    (Optional) ID of the root clique
+
+    Output:
+    -------
+
+    A junction tree structure rooted at the given clique
+
+    """
+
+    return ArrayTree.from_edges(num_cliques, edges, root).to_tree()
 
 
 def build_sepset_heap(sepsets, cliques, key_sizes):
@@ -698,6 +1173,147 @@ def eliminate_variables(junction_tree):
 
 
 
+def compile_elimination(factors, key_sizes, query, heuristic="min_fill"):
+    """
+    Compile variable elimination for the joint marginal of query keys
+
+    The keys not in the query are eliminated in the order given by the
+        elimination heuristic (query keys are ranked after all other keys).
+        Each elimination is a contraction of the factors and intermediate
+        results containing the eliminated key. The keys of each
+        contraction are mapped to small integers so that only the keys of
+        one contraction count towards the einsum label limit.
+
+    Input:
+    ------
+
+    List of factors (lists of keys)
+
+    Dictionary of key sizes
+
+    List of query keys
+
+    Elimination heuristic (see find_triangulation). Only one ordering is
+        computed, so a RandomRestarts instance is replaced by the heuristic
+        it randomizes.
+
+    Output:
+    -------
+
+    List of contractions. The operands are numbered so that the factors come
+        first and the result of each contraction is appended after them.
+        The last contraction gives the marginal of the query keys (in the
+        given order). Each contraction is a tuple:
+
+    (
+        operand indices,
+        mapped keys of the operands (with leading Ellipsis for batch axes),
+        mapped keys of the result
+    )
+
+    """
+
+    heuristic = get_heuristic(heuristic)
+    if isinstance(heuristic, RandomRestarts):
+        heuristic = heuristic.heuristic
+    query = list(query)
+    query_set = set(query)
+    unknown = query_set.difference(key for factor in factors for key in factor)
+    if unknown:
+        raise ValueError("Query keys not in any factor: {0}".format(unknown))
+
+    def __heuristic(key, neighbors, fill_edges, key_sizes):
+        return (key in query_set,) + tuple(
+            heuristic(key, neighbors, fill_edges, key_sizes)
+        )
+
+    used_keys = set(key for factor in factors for key in factor)
+    (ordering, _) = find_elimination_ordering(
+                            {
+                                key: size
+                                for (key, size) in key_sizes.items()
+                                if key in used_keys
+                            },
+                            factors_to_adjacency(factors),
+                            __heuristic
+    )
+
+    def __contraction(operands, result_keys):
+        keymap = {}
+        for (_, keys) in operands:
+            for key in keys:
+                keymap.setdefault(key, len(keymap))
+        return (
+            [i for (i, _) in operands],
+            [[Ellipsis] + [keymap[key] for key in keys] for (_, keys) in operands],
+            [Ellipsis] + [keymap[key] for key in result_keys]
+        )
+
+    # keys of the remaining operands and the remaining operands of each key
+    operands = dict(enumerate(factors))
+    key_to_operands = {}
+    for (i, keys) in operands.items():
+        for key in keys:
+            key_to_operands.setdefault(key, set()).add(i)
+
+    contractions = []
+    for (key, _) in ordering:
+        if key in query_set:
+            break
+        involved = [
+            (i, operands.pop(i))
+            for i in sorted(key_to_operands.pop(key))
+        ]
+        result_ix = len(factors) + len(contractions)
+        result_keys = []
+        for (i, keys) in involved:
+            for k in keys:
+                if k != key:
+                    key_to_operands[k].discard(i)
+                    if result_ix not in key_to_operands[k]:
+                        key_to_operands[k].add(result_ix)
+                        result_keys.append(k)
+        contractions.append(__contraction(involved, result_keys))
+        operands[result_ix] = result_keys
+
+    contractions.append(__contraction(list(operands.items()), query))
+    return contractions
+
+
+def run_elimination(contractions, xs, distributive_law):
+    """
+    Run variable elimination compiled with compile_elimination
+
+    Input:
+    ------
+
+    List of contractions (see compile_elimination)
+
+    List of factor values (with optional leading batch axes)
+
+    Distributive law for performing sum product calculations
+
+    Output:
+    -------
+
+    Marginal of the query keys
+
+    """
+
+    operands = list(xs)
+    for (indices, operand_keys, result_keys) in contractions:
+        args = [
+            arg
+            for (i, keys) in zip(indices, operand_keys)
+            for arg in (operands[i], keys)
+        ] + [result_keys]
+        operands.append(distributive_law.einsum(*args))
+        # release the intermediate results as soon as they are used
+        for i in indices:
+            operands[i] = None
+    return operands[-1]
+
+
 def collect(tree, node_list, potentials, visited, distributive_law, shrink_mapping=None):
     """
     Used by Hugin algorithm to collect messages
@@ -889,6 +1505,545 @@ def hugin(tree, node_list, potentials, distributive_law, shrink_mapping=None):
                     shrink_mapping
     )
 
+
+def map_keys(keys, *sub_keys):
+    """
+    Map keys to integers accepted by einsum
+
+    Input:
+    ------
+
+    List of keys defining the mapping (key at position i is mapped to i)
+
+    Lists of keys (subsets of the first list) to be mapped
+
+    Output:
+    -------
+
+    List of mapped keys for each of the given key lists (the first list
+        included). Each mapped list starts with an Ellipsis so that leading
+        batch axes of the arrays are carried through einsum
+
+    """
+
+    m_keys = {k: i for (i, k) in enumerate(keys)}
+    return [[Ellipsis] + list(range(len(keys)))] + [
+        [Ellipsis] + [m_keys[k] for k in s_keys]
+        for s_keys in sub_keys
+    ]
+
+
+def compile_schedule(tree, node_list):
+    """
+    Compile the message passing schedule of Hugin algorithm
+
+    The tree is walked once and each message is stored with the einsum
+        keys needed to pass it so that the tree structure does not have
+        to be traversed or keys mapped again when propagating potentials
+
+    Input:
+    ------
+
+    The tree structure of the junction tree
+
+    List of nodes in tree
+
+    Output:
+    -------
+
+    List of messages in the order they are passed (collect phase followed
+        by distribute phase). Each message is a tuple:
+
+    (
+        source clique ID,
+        separator ID,
+        target clique ID,
+        source clique mapped keys,
+        target clique mapped keys,
+        separator keys mapped to source clique keys,
+        separator keys mapped to target clique keys,
+        alignment of separator axes to target clique axes
+    )
+
+    """
+
+    def __message(source, sep_ix, target):
+        (source_keys, sep1_keys) = map_keys(node_list[source], node_list[sep_ix])
+        (target_keys, sep2_keys) = map_keys(node_list[target], node_list[sep_ix])
+        return (
+            source,
+            sep_ix,
+            target,
+            source_keys,
+            target_keys,
+            sep1_keys,
+            sep2_keys,
+            compile_alignment(sep2_keys[1:], target_keys[1:])
+        )
+
+    # (parent ID, separator ID, child ID) triplets in depth-first pre-order
+    # and post-order, i.e., the order in which distribute and collect
+    # visit the edges
+    pre_order = []
+    post_order = []
+    stack = [(tree, None, False)]
+    while stack:
+        (t, edge, expanded) = stack.pop()
+        if expanded:
+            post_order.append(edge)
+            continue
+        if edge:
+            pre_order.append(edge)
+            stack.append((t, edge, True))
+        stack.extend(
+            [
+                (child, (t[0], sep_ix, child[0]), False)
+                for (sep_ix, child) in reversed(t[1:])
+            ]
+        )
+
+    # collect: messages from child to parent
+    collect_messages = [
+        __message(child, sep_ix, parent)
+        for (parent, sep_ix, child) in post_order
+    ]
+
+    # distribute: messages from parent to child
+    distribute_messages = [
+        __message(parent, sep_ix, child)
+        for (parent, sep_ix, child) in pre_order
+    ]
+
+    return collect_messages + distribute_messages
+
+
+def run_schedule(schedule, potentials, distributive_law):
+    """
+    Propagate potentials by passing the messages of a compiled schedule
+
+    Input:
+    ------
+
+    Message schedule (see compile_schedule)
+
+    List of (inconsistent) clique and separator potentials
+
+    Distributive law for performing sum product calculations
+
+    Output:
+    -------
+
+    List of (consistent) clique and separator potentials
+
+    """
+
+    for (source, sep_ix, target, source_keys, target_keys, sep1_keys, sep2_keys, _) in schedule:
+        (potentials[target], potentials[sep_ix]) = distributive_law.update_mapped(
+                                                    potentials[source],
+                                                    source_keys,
+                                                    potentials[target],
+                                                    target_keys,
+                                                    potentials[sep_ix],
+                                                    sep1_keys,
+                                                    sep2_keys
+        )
+
+    return potentials
+
+
+def run_schedule_inplace(schedule, potentials, scratch, distributive_law):
+    """
+    Same as run_schedule but the potentials are updated in place
+
+    The clique potentials are updated in place. Each separator has two
+        buffers of the same shape: one holds the separator potential and
+        the other one is used for the new separator potential of a message.
+        The buffers swap their roles after each message, so no arrays are
+        allocated during propagation.
+
+    Input:
+    ------
+
+    Message schedule (see compile_schedule)
+
+    List of (inconsistent) clique and separator potentials with the same
+        (broadcast) batch axes
+
+    List of separator buffers (indexed by separator ID as potentials)
+
+    Distributive law for performing sum product calculations
+
+    Output:
+    -------
+
+    List of (consistent) clique and separator potentials
+
+    """
+
+    for (source, sep_ix, target, source_keys, _, sep1_keys, _, alignment) in schedule:
+        new_sep_pot = distributive_law.project_mapped(
+                                potentials[source],
+                                source_keys,
+                                sep1_keys,
+                                out=scratch[sep_ix]
+        )
+        distributive_law.absorb_inplace(
+                                potentials[target],
+                                potentials[sep_ix],
+                                new_sep_pot,
+                                alignment
+        )
+        (potentials[sep_ix], scratch[sep_ix]) = (new_sep_pot, potentials[sep_ix])
+
+    return potentials
+
+
+def run_schedule_chunked(schedule, potentials, scratch, distributive_law, tile_size):
+    """
+    Same as run_schedule_inplace but the clique potentials are read and
+        updated in tiles
+
+    The cliques are split along the axes of the keys that are not in the
+        separator of a message. This bounds the size of temporary arrays and
+        the clique potentials don't need to fit in memory (e.g., they can be
+        numpy.memmap arrays). Separator potentials are kept as they are.
+
+    Input:
+    ------
+
+    Message schedule (see compile_schedule)
+
+    List of (inconsistent) clique and separator potentials with the same
+        (broadcast) batch axes
+
+    List of separator buffers (indexed by separator ID as potentials)
+
+    Distributive law for performing sum product calculations
+
+    Maximum size of a tile in bytes
+
+    Output:
+    -------
+
+    List of (consistent) clique and separator potentials
+
+    """
+
+    for (source, sep_ix, target, source_keys, target_keys, sep1_keys, sep2_keys, alignment) in schedule:
+        new_sep_pot = distributive_law.project_chunked(
+                                potentials[source],
+                                source_keys,
+                                sep1_keys,
+                                tile_slices(potentials[source], source_keys, sep1_keys, tile_size),
+                                out=scratch[sep_ix]
+        )
+        distributive_law.absorb_chunked(
+                                potentials[target],
+                                potentials[sep_ix],
+                                new_sep_pot,
+                                alignment,
+                                tile_slices(potentials[target], target_keys, sep2_keys, tile_size)
+        )
+        (potentials[sep_ix], scratch[sep_ix]) = (new_sep_pot, potentials[sep_ix])
+
+    return potentials
+
+
+def compile_levels(schedule, depths):
+    """
+    Group the messages of a compiled schedule into levels of independent
+        tasks
+
+    In collect phase, the messages from the cliques at the same depth are
+        independent except that the messages to the same parent update the
+        same clique. In distribute phase, the messages to the cliques at the
+        same depth are independent. Thus, messages of one level are grouped
+        by the target clique and the groups can be run concurrently.
+
+    Input:
+    ------
+
+    Message schedule (see compile_schedule)
+
+    Depth of each clique in the tree
+
+    Output:
+    -------
+
+    List of levels in the order they are run. Each level is a list of tasks
+        and each task a list of messages (in schedule order) to one target
+
+    """
+
+    collect_levels = {}
+    distribute_levels = {}
+    for message in schedule:
+        (source, _, target) = message[:3]
+        (levels, depth) = (
+            (collect_levels, depths[source])
+            if depths[source] > depths[target] else
+            (distribute_levels, depths[target])
+        )
+        levels.setdefault(depth, {}).setdefault(target, []).append(message)
+
+    return [
+        list(collect_levels[depth].values())
+        for depth in sorted(collect_levels, reverse=True)
+    ] + [
+        list(distribute_levels[depth].values())
+        for depth in sorted(distribute_levels)
+    ]
+
+
+def run_levels(levels, potentials, distributive_law, executor, scratch=None):
+    """
+    Same as run_schedule (or run_schedule_inplace if scratch is given) but
+        the independent messages of each level are passed concurrently
+
+    The new separator potentials of a level are projected concurrently
+        first. Then, the tasks absorb them into the target cliques, each task
+        into one clique. NumPy releases the GIL in the numeric kernels, so
+        large potentials are processed in parallel by a thread pool.
+
+    Input:
+    ------
+
+    Levels of tasks (see compile_levels)
+
+    List of (inconsistent) clique and separator potentials
+
+    Distributive law for performing sum product calculations
+
+    Executor (e.g., concurrent.futures.ThreadPoolExecutor) running the tasks
+
+    List of separator buffers for in-place propagation (optional)
+
+    Output:
+    -------
+
+    List of (consistent) clique and separator potentials
+
+    """
+
+    def __project(message):
+        (source, sep_ix, _, source_keys, _, sep1_keys, _, _) = message
+        return distributive_law.project_mapped(
+                                potentials[source],
+                                source_keys,
+                                sep1_keys,
+                                out=None if scratch is None else scratch[sep_ix]
+        )
+
+    def __absorb(task):
+        for (message, new_sep_pot) in task:
+            (_, sep_ix, target, _, target_keys, _, sep2_keys, alignment) = message
+            if scratch is None:
+                potentials[target] = distributive_law.absorb_mapped(
+                                        potentials[target],
+                                        target_keys,
+                                        potentials[sep_ix],
+                                        new_sep_pot,
+                                        sep2_keys
+                )
+                potentials[sep_ix] = new_sep_pot
+            else:
+                distributive_law.absorb_inplace(
+                                        potentials[target],
+                                        potentials[sep_ix],
+                                        new_sep_pot,
+                                        alignment
+                )
+                (potentials[sep_ix], scratch[sep_ix]) = (new_sep_pot, potentials[sep_ix])
+
+    for level in levels:
+        messages = [message for task in level for message in task]
+        new_sep_pots = iter(
+            list(executor.map(__project, messages))
+            if len(messages) > 1 else
+            map(__project, messages)
+        )
+        tasks = [
+            [(message, next(new_sep_pots)) for message in task]
+            for task in level
+        ]
+        # wait for the level to finish (and raise errors of the tasks)
+        list(executor.map(__absorb, tasks) if len(tasks) > 1 else map(__absorb, tasks))
+
+    return potentials
+
+
+def shafer_shenoy(tree, node_list, potentials, distributive_law):
+    """
+    Run Shafer-Shenoy algorithm by using the given distributive law.
+
+    Input:
+    ------
+
+    The tree structure of the junction tree
+
+    List of nodes in tree
+
+    List of (inconsistent) clique potentials (separator potentials are not
+        used)
+
+    Distributive law for performing sum product calculations
+
+    Output:
+    -------
+
+    List of (consistent) clique and separator potentials
+
+    """
+
+    return run_shafer_shenoy(
+        compile_schedule(tree, node_list),
+        list(potentials) + [None] * (len(node_list) - len(potentials)),
+        distributive_law
+    )
+
+
+def run_shafer_shenoy(schedule, potentials, distributive_law):
+    """
+    Propagate potentials with Shafer-Shenoy algorithm using a compiled
+        schedule
+
+    Unlike in Hugin algorithm, the clique potentials are not updated but the
+        messages between cliques are stored. A message from a clique is the
+        product of the clique potential and the messages to the clique from
+        its other neighbors marginalized to the separator. No divisions are
+        needed. The consistent clique (separator) potentials are the products
+        of the initial clique potentials and all the incoming messages (the
+        two messages through the separator).
+
+    Input:
+    ------
+
+    Message schedule (see compile_schedule)
+
+    List of (inconsistent) clique and separator potentials (separator
+        potentials are not used)
+
+    Distributive law for performing sum product calculations
+
+    Output:
+    -------
+
+    List of (consistent) clique and separator potentials
+
+    """
+
+    # each separator passes one message to both directions
+    num_cliques = len(potentials) - len(schedule) // 2
+    clique_keys = [None] * num_cliques
+
+    # messages to each clique: (source clique ID, message, mapped keys)
+    incoming = [[] for _ in range(num_cliques)]
+    separators = [None] * (len(potentials) - num_cliques)
+
+    for (source, sep_ix, target, source_keys, target_keys, sep1_keys, sep2_keys, _) in schedule:
+        clique_keys[source] = source_keys
+        clique_keys[target] = target_keys
+        args = [potentials[source], source_keys]
+        for (other, message, keys) in incoming[source]:
+            if other != target:
+                args.extend([message, keys])
+        message = distributive_law.einsum(*args, sep1_keys)
+        incoming[target].append((source, message, sep2_keys))
+
+        # the messages to both directions have the separator axes in the
+        # same order
+        sep_message = separators[sep_ix - num_cliques]
+        separators[sep_ix - num_cliques] = (
+            message if sep_message is None else
+            distributive_law.multiply(sep_message, message)
+        )
+
+    cliques = [
+        potentials[c_ix] if len(incoming[c_ix]) == 0 else
+        distributive_law.einsum(
+            potentials[c_ix],
+            clique_keys[c_ix],
+            *[arg for (_, message, keys) in incoming[c_ix] for arg in (message, keys)],
+            clique_keys[c_ix]
+        )
+        for c_ix in range(num_cliques)
+    ]
+
+    return cliques + separators
+
+
+def find_map_assignment(order, cliques, potentials):
+    """
+    Decode the most probable joint assignment from max-marginals
+
+    The cliques are visited in the given order and in each clique the best
+        values of the keys not yet assigned are chosen given the values of
+        the keys already assigned (traceback).
+
+    Input:
+    ------
+
+    Clique IDs in an order where each clique shares keys only with its
+        parent visited earlier (e.g., pre-order of the Junction tree)
+
+    List of keys in each clique
+
+    Clique potentials calibrated with max-product distributive law
+
+    Output:
+    -------
+
+    Dictionary from each key to the index of its most probable value (an
+        array of the broadcast batch shape if potentials have batch axes)
+
+    """
+
+    batch_shape = np.broadcast_shapes(
+        *[
+            np.shape(potentials[c_ix])[:np.ndim(potentials[c_ix])-len(cliques[c_ix])]
+            for c_ix in order
+        ]
+    )
+    batch_size = int(np.prod(batch_shape))
+
+    assignment = {}
+    for c_ix in order:
+        keys = cliques[c_ix]
+        pot = np.asarray(potentials[c_ix])
+        shape = np.shape(pot)[np.ndim(pot)-len(keys):]
+        pot = np.reshape(
+            np.broadcast_to(pot, batch_shape + shape),
+            (batch_size,) + shape
+        )
+
+        # condition on the keys assigned in earlier cliques
+        for (i, key) in enumerate(keys):
+            if key in assignment:
+                pot = np.take_along_axis(
+                    pot,
+                    np.reshape(assignment[key], (batch_size,) + len(keys)*(1,)),
+                    axis=i+1
+                )
+
+        free = [(key, size) for (key, size) in zip(keys, shape) if key not in assignment]
+        if len(free) == 0:
+            continue
+
+        best = np.unravel_index(
+            np.argmax(np.reshape(pot, (batch_size, -1)), axis=1),
+            [size for (_, size) in free]
+        )
+        for ((key, _), ind) in zip(free, best):
+            assignment[key] = ind
+
+    if batch_shape == ():
+        return {key: int(ind[0]) for (key, ind) in assignment.items()}
+    return {
+        key: np.reshape(ind, batch_shape)
+        for (key, ind) in assignment.items()
+    }
+
+
 def get_clique(tree, node_list, key_label):
     """
     Finds a clique containing key with label key_label
@@ -1196,8 +2351,16 @@ def generate_potential_pairs(tree):
 
 
 # Sum-product distributive law for NumPy
-sum_product = SumProduct(np.einsum)
-# setting optimize to true allows einsum to benefit from speed up due to
-# contraction order optimization but at the cost of memory usage
-# need to evaulate tradeoff within library
-#sum_product = SumProduct(np.einsum,optimize=True)
+#
+# Contraction paths are optimized for einsums of many operands (e.g., when
+# evaluating cliques with many factors). The paths are cached so the same tree
+# doesn't need path optimization again and intermediate results are limited
+# to the operand sizes to keep memory usage in check. Contractions with more
+# keys than numpy.einsum supports fall back to batched matrix products.
+sum_product = SumProduct(sp.einsum, einsum_path=np.einsum_path)
+
+# Sum-product distributive law for potentials in log space
+log_sum_product = LogSumProduct()
+
+# Max-product distributive law for finding the most probable assignment
+max_product = MaxProduct()
@@ -3,15 +3,143 @@ Simple user interface for the Junction tree algorithm library
 """
 
 import numpy as np
+import functools
+import hashlib
+import multiprocessing
+import os
+import pickle
+import struct
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from . import beliefpropagation as bp
+from .sum_product import compile_alignment, run_alignment, tile_slices, broadcast_shape
+from . import sum_product as sp
+from .arraytree import ArrayTree
 import attr
 
 
-def create_junction_tree(factors, sizes):
-    """Create a Junction tree for a given factor graph."""
+# Header of saved Junction trees. The format version is incremented whenever
+# the pickled structure of the compiled tree changes.
+MAGIC = b"JNCTREE"
+FORMAT_VERSION = 1
+
+# Default size of a tile (in bytes) in out-of-core propagation
+DEFAULT_TILE_SIZE = 2**23
+
+# Maximum number of compiled variable eliminations kept by a factor graph
+ELIMINATION_CACHE_SIZE = 128
+
+
+def create_junction_tree(factors, sizes, heuristic="min_fill", cache_dir=None):
+    """Create a Junction tree for a given factor graph.
+
+    The heuristic determines the elimination order used in triangulation
+    (see `bp.find_triangulation`).
+
+    If a cache directory is given, the compiled tree is loaded from there
+    when a tree of the same factors, sizes and heuristic has been created
+    before (see `cache_key`). Otherwise, the created tree is saved there.
+
+    """
+    if cache_dir is not None:
+        path = os.path.join(
+            cache_dir,
+            cache_key(factors, sizes, heuristic) + ".jtree"
+        )
+        try:
+            return load_junction_tree(path)
+        except Exception:
+            # missing, outdated or corrupted entry (unpickling a stale entry
+            # may fail in many ways, e.g., if a class has been renamed)
+            pass
+
     fg = FactorGraph(factors=factors, sizes=sizes)
-    return fg.triangulate().create_junction_tree()
+    tree = fg.triangulate(heuristic=heuristic).create_junction_tree()
+
+    if cache_dir is not None:
+        # write to a temporary file first so that concurrent readers never
+        # see a partially written tree
+        os.makedirs(cache_dir, exist_ok=True)
+        (fd, tmp_path) = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                save_junction_tree(tree, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return tree
+
+
+def cache_key(factors, sizes, heuristic="min_fill"):
+    """Hash of the factor structure, key sizes and heuristic of a tree.
+
+    Heuristics are identified by their names, the qualified names of scoring
+    functions or the settings of `bp.RandomRestarts`.
+
+    """
+
+    def __describe(h):
+        if isinstance(h, bp.RandomRestarts):
+            return ("RandomRestarts", __describe(h.heuristic), h.restarts, h.seed)
+        if callable(h):
+            return "{0}.{1}".format(h.__module__, h.__qualname__)
+        return h
+
+    description = repr(
+        (
+            FORMAT_VERSION,
+            [list(factor) for factor in factors],
+            sorted(((repr(key), size) for (key, size) in sizes.items())),
+            __describe(heuristic),
+        )
+    )
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+
+def save_junction_tree(tree, file):
+    """Save a compiled Junction tree to a file (a path or a binary file).
+
+    The tree is stored with its precomputed schedules and plans after a
+    header of a magic string and a format version, so loading doesn't
+    triangulate or compile anything.
+
+    """
+    if not hasattr(file, "write"):
+        with open(file, "wb") as f:
+            return save_junction_tree(tree, f)
+    file.write(MAGIC + struct.pack("<H", FORMAT_VERSION))
+    pickle.dump(tree, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_junction_tree(file):
+    """Load a Junction tree saved by `save_junction_tree`.
+
+    Raises ValueError if the file is not a saved Junction tree or has been
+    saved in another format version. The trees are unpickled, so only files
+    from trusted sources should be loaded.
+
+    """
+    if not hasattr(file, "read"):
+        with open(file, "rb") as f:
+            return load_junction_tree(f)
+    header = file.read(len(MAGIC) + 2)
+    if header[:len(MAGIC)] != MAGIC or len(header) != len(MAGIC) + 2:
+        raise ValueError("Not a saved Junction tree")
+    (version,) = struct.unpack("<H", header[len(MAGIC):])
+    if version != FORMAT_VERSION:
+        raise ValueError(
+            "Unsupported Junction tree format version {0} (expected {1})".format(
+                version,
+                FORMAT_VERSION
+            )
+        )
+    tree = pickle.load(file)
+    if not isinstance(tree, JunctionTree):
+        raise ValueError("Not a saved Junction tree")
+    return tree
 
 
 def argfind1(xs, cond):
@@ -29,7 +157,7 @@ def is_subset(a, b):
     return set(a).issubset(set(b))
 
 
-def einsum(xs, xs_keys, y_keys):
+def einsum(xs, xs_keys, y_keys, distributive_law=None):
     """Thin wrapper for numpy.einsum with some extra support.
 
     Adds support for:
@@ -38,11 +166,44 @@ def einsum(xs, xs_keys, y_keys):
 
     - some keys only in outputs (they are created as new axes)
 
+    - leading batch axes (axes in addition to the keys are broadcast and
+      kept in the output)
+
+    - other distributive laws (the einsum of the given law is used instead
+      of numpy.einsum)
+
+    - more keys than numpy.einsum supports
+
+    The compiled key mappings are cached for repeated calls with the same
+    keys.
+
+    """
+    return run_einsum(
+        xs,
+        _cached_compile_einsum(
+            tuple(tuple(x_keys) for x_keys in xs_keys),
+            tuple(y_keys)
+        ),
+        distributive_law
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def _cached_compile_einsum(xs_keys, y_keys):
+    return compile_einsum(xs_keys, y_keys)
+
+
+def compile_einsum(xs_keys, y_keys):
+    """Map arbitrary keys to a numpy.einsum argument list.
+
+    Returns a tuple (number of keys only in outputs, input sublists, output
+    sublist) which can be computed once and evaluated with `run_einsum`.
+
     """
 
     # Find keys
     input_keys = list(set([key for x_keys in xs_keys for key in x_keys]))
-    all_keys = list(set(y_keys + input_keys))
+    all_keys = list(set(list(y_keys) + input_keys))
 
     # Einsum doesn't support keys that are only in the output. Thus, if some
     # keys are only in outputs, add those keys as auxiliary axes to the first
@@ -52,11 +213,7 @@ def einsum(xs, xs_keys, y_keys):
         for key in all_keys
         if key not in input_keys
     ]
-    xs[0] = np.reshape(
-        xs[0],
-        len(missing_input_keys) * (1,) + np.shape(xs[0])
-    )
-    xs_keys[0] = missing_input_keys + xs_keys[0]
+    xs_keys = [missing_input_keys + list(xs_keys[0])] + list(xs_keys[1:])
 
     # Mapping from arbitrary keys to numpy.einsum acceptable keys
     keymap = {
@@ -64,18 +221,199 @@ def einsum(xs, xs_keys, y_keys):
         for (i, key) in enumerate(all_keys)
     }
 
+    return (
+        len(missing_input_keys),
+        [
+            [Ellipsis] + [keymap[key] for key in x_keys]
+            for x_keys in xs_keys
+        ],
+        [Ellipsis] + [keymap[key] for key in y_keys]
+    )
+
+
+def run_einsum(xs, compiled, distributive_law=None):
+    """Evaluate an einsum compiled with `compile_einsum`."""
+
+    (num_missing, xs_sublists, y_sublist) = compiled
+
+    # The auxiliary axes of keys only in outputs are added after the batch
+    # axes of the first input
+    xs = list(xs)
+    if num_missing > 0:
+        num_batch = np.ndim(xs[0]) - len(xs_sublists[0]) + 1 + num_missing
+        xs[0] = np.reshape(
+            xs[0],
+            np.shape(xs[0])[:num_batch]
+            + num_missing * (1,)
+            + np.shape(xs[0])[num_batch:]
+        )
+
     # numpy.einsum argument list
     argsi = [
         arg
-        for x_and_keys in zip(xs, xs_keys)
-        for arg in (
-                x_and_keys[0],
-                [keymap[key] for key in x_and_keys[1]]
-        )
+        for x_and_sublist in zip(xs, xs_sublists)
+        for arg in x_and_sublist
     ] + [
-        [keymap[key] for key in y_keys]
+        y_sublist
+    ]
+    if distributive_law is None:
+        return sp.einsum(*argsi)
+    return distributive_law.einsum(*argsi)
+
+
+def compile_product(xs_keys, y_keys):
+    """Plan the elementwise product of arrays into an array of given keys.
+
+    Arrays whose keys are a subset of the keys of a larger array are grouped
+    with that array. Returns a list of (index, alignment, [(index,
+    alignment), ...]) groups which are evaluated with `run_product`.
+
+    """
+
+    # larger arrays first so that smaller ones can be grouped with them
+    order = sorted(range(len(xs_keys)), key=lambda i: -len(set(xs_keys[i])))
+    groups = []
+    for i in order:
+        group = next(
+            (
+                group
+                for group in groups
+                if set(xs_keys[i]).issubset(xs_keys[group[0]])
+            ),
+            None
+        )
+        alignment = compile_alignment(xs_keys[i], y_keys)
+        if group is None:
+            groups.append((i, alignment, []))
+        else:
+            group[2].append((i, alignment))
+    return groups
+
+
+def run_product(xs, groups, distributive_law=bp.sum_product, out=None):
+    """Multiply arrays into a new array as planned with `compile_product`.
+
+    The product is computed in a single preallocated output array: the first
+    two terms are multiplied into it and the rest are multiplied in place, so
+    no temporaries of the output size are created. The arrays grouped with a
+    larger array are multiplied together first, which is cheap as their keys
+    are a subset of the keys of the larger array. Keys of the output that are
+    not in any array get axes of size one. Leading batch axes are broadcast.
+
+    If out is given, the product is stored in it (the terms are broadcast to
+    its shape).
+
+    """
+
+    terms = []
+    for (i, alignment, subgroup) in groups:
+        terms.append(run_alignment(xs[i], alignment))
+        if len(subgroup) > 0:
+            terms.append(
+                functools.reduce(
+                    distributive_law.multiply,
+                    [run_alignment(xs[j], a) for (j, a) in subgroup]
+                )
+            )
+
+    if out is not None:
+        y = out
+    elif len(terms) == 1:
+        return np.array(terms[0])
+    else:
+        y = np.empty(
+            broadcast_shape(*[np.shape(x) for x in terms]),
+            dtype=functools.reduce(np.promote_types, [x.dtype for x in terms])
+        )
+
+    if len(terms) == 1:
+        np.copyto(y, terms[0])
+    else:
+        distributive_law.multiply(terms[0], terms[1], out=y)
+    for x in terms[2:]:
+        distributive_law.multiply(y, x, out=y)
+    return y
+
+
+def observe(x, x_keys, evidence):
+    """Slice the axes of observed keys to the observed values.
+
+    The sliced axes are kept with size one so the keys of the array don't
+    change. Leading batch axes are not affected. Returns a view of x.
+
+    """
+    x = np.asarray(x)
+    num_batch = np.ndim(x) - len(x_keys)
+    index = num_batch * [slice(None)]
+    for (key, size) in zip(x_keys, np.shape(x)[num_batch:]):
+        if key in evidence:
+            value = evidence[key]
+            if not 0 <= value < size:
+                raise ValueError(
+                    "Observed value {0} of key {1} out of range".format(value, key)
+                )
+            index.append(slice(value, value+1))
+        else:
+            index.append(slice(None))
+    return x[tuple(index)]
+
+
+def share_arrays(xs):
+    """Copy arrays into one block of shared memory.
+
+    Returns the shared memory block and the layout (offset, shape and type of
+    each array) from which the arrays can be attached in other processes. The
+    caller must close and unlink the block.
+
+    """
+    # imported here because multiprocessing.shared_memory needs Python 3.8
+    from multiprocessing import shared_memory
+
+    xs = [np.asarray(x) for x in xs]
+    layout = []
+    offset = 0
+    for x in xs:
+        # keep every array aligned for its type
+        offset = -(-offset // x.itemsize) * x.itemsize
+        layout.append((offset, x.shape, x.dtype.str))
+        offset += x.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for (x, y) in zip(xs, attach_arrays(shm, layout)):
+        np.copyto(y, x)
+    return (shm, layout)
+
+
+def attach_arrays(shm, layout):
+    """Arrays viewing a block of shared memory (see `share_arrays`)."""
+    return [
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        for (offset, shape, dtype) in layout
     ]
-    return np.einsum(*argsi)
+
+
+# State of a worker process of JunctionTree.propagate_many
+_worker = {}
+
+
+def _initialize_worker(tree, distributive_law, name, layout):
+    """Attach the shared factor values in a worker process."""
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=name)
+    xs = attach_arrays(shm, layout)
+    for x in xs:
+        x.flags.writeable = False
+    # the block must stay open as long as the arrays are used
+    _worker.update(tree=tree, distributive_law=distributive_law, shm=shm, xs=xs)
+
+
+def _propagate_worker(evidence):
+    """Propagate the shared factor values with one set of evidence."""
+    return _worker["tree"].propagate(
+        _worker["xs"],
+        _worker["distributive_law"],
+        evidence
+    )
 
 
 @attr.s(frozen=True)
@@ -96,15 +434,86 @@ class FactorGraph():
     # Size of each axis
     sizes = attr.ib()
 
+    # Compiled variable eliminations by (query keys, heuristic)
+    eliminations = attr.ib(init=False, eq=False, repr=False, factory=dict)
+
+
+    def __getstate__(self):
+        # The compiled eliminations are a cache which is not pickled (e.g.,
+        # in a saved Junction tree)
+        state = dict(self.__dict__)
+        del state["eliminations"]
+        return state
+
+
+    def __setstate__(self, state):
+        # The cache is also missing from trees saved before it was added
+        self.__dict__.update(state, eliminations={})
+
+
+    def eliminate(self, xs, keys, evidence=None, distributive_law=bp.sum_product, heuristic="min_fill"):
+        """Compute the joint marginal of the given keys by variable elimination.
+
+        The other keys are eliminated one at a time in the order given by the
+        elimination heuristic, so no Junction tree is created and only the
+        contractions needed for this marginal are computed. This is faster
+        than creating and propagating a Junction tree for a single query. The
+        contractions are compiled once for each combination of keys and
+        heuristic (see `bp.compile_elimination`), and the latest
+        `ELIMINATION_CACHE_SIZE` of them are kept. A `bp.RandomRestarts`
+        heuristic is replaced by the heuristic it randomizes.
+
+        The axes of the result are the batch axes of xs followed by the axes
+        of the keys in the given order. Evidence is handled as in
+        `JunctionTree.propagate`, that is, the axes of observed keys have size
+        one.
+
+        """
 
-    def triangulate(self):
+        # Only the base heuristic affects the elimination (see
+        # bp.compile_elimination), so new RandomRestarts instances share plans
+        heuristic = bp.get_heuristic(heuristic)
+        if isinstance(heuristic, bp.RandomRestarts):
+            heuristic = heuristic.heuristic
+        plan_key = (tuple(keys), heuristic)
+        contractions = self.eliminations.get(plan_key)
+        if contractions is None:
+            if len(self.eliminations) >= ELIMINATION_CACHE_SIZE:
+                # drop the oldest plan
+                del self.eliminations[next(iter(self.eliminations))]
+            contractions = bp.compile_elimination(
+                self.factors,
+                self.sizes,
+                keys,
+                heuristic
+            )
+            self.eliminations[plan_key] = contractions
+
+        if evidence:
+            unknown = set(evidence).difference(self.sizes)
+            if unknown:
+                raise ValueError("Unknown observed keys: {0}".format(unknown))
+            xs = [
+                observe(x, x_keys, evidence)
+                for (x, x_keys) in zip(xs, self.factors)
+            ]
+
+        return bp.run_elimination(
+            contractions,
+            xs,
+            distributive_law
+        )
+
+
+    def triangulate(self, heuristic="min_fill"):
         """Create a triangulated clique tree from a factor graph."""
 
         # Let's use the triangulation methods of undirected graphs.
 
         (_, _, maxcliques, factor_to_maxclique) = bp.find_triangulation(
             self.factors,
-            self.sizes
+            self.sizes,
+            heuristic
         )
 
 
@@ -132,6 +541,51 @@ class CliqueGraph():
     # The underlying factor graph
     factor_graph = attr.ib()
 
+    # Factors for each maximal clique (computed once from factor_to_maxclique)
+    maxclique_to_factors = attr.ib(init=False, eq=False, repr=False)
+
+    # Compiled products (see compile_product) for evaluating each maxclique
+    # from its factors and einsums (see compile_einsum) for marginalizing each
+    # factor from its maxclique
+    evaluation_products = attr.ib(init=False, eq=False, repr=False)
+    marginalization_einsums = attr.ib(init=False, eq=False, repr=False)
+
+
+    @maxclique_to_factors.default
+    def _find_maxclique_factors(self):
+        maxclique_to_factors = [[] for _ in self.maxcliques]
+        for (i, maxclique) in enumerate(self.factor_to_maxclique):
+            maxclique_to_factors[maxclique].append(i)
+        return maxclique_to_factors
+
+
+    @evaluation_products.default
+    def _compile_evaluation_products(self):
+        return [
+            compile_product(
+                take(self.factor_graph.factors, factors),
+                maxclique
+            )
+            for (factors, maxclique) in zip(
+                    self.maxclique_to_factors,
+                    self.maxcliques
+            )
+        ]
+
+
+    @marginalization_einsums.default
+    def _compile_marginalization_einsums(self):
+        return [
+            compile_einsum(
+                [self.maxcliques[maxclique]],
+                factor_keys
+            )
+            for (factor_keys, maxclique) in zip(
+                    self.factor_graph.factors,
+                    self.factor_to_maxclique
+            )
+        ]
+
 
     def create_junction_tree(self):
         """Create a Junction tree from a triangulated clique tree."""
@@ -198,33 +652,49 @@ class CliqueGraph():
         )
 
 
-    def evaluate(self, xs):
-        """Compute maximum clique values based on factor values."""
+    def evaluate(self, xs, distributive_law=bp.sum_product, sizes=None, out=None):
+        """Compute maximum clique values based on factor values.
 
-        # FIXME: This should be computed once at creation time because it
-        # doesn't depend on xs. Computing it every time here adds overhead.
-        maxclique_to_factors = [
-            [
-                i for (i, y) in enumerate(self.factor_to_maxclique)
-                if y == maxclique
-            ]
-            for maxclique in range(len(self.maxcliques))
-        ]
+        Maxcliques without any factors get the neutral potential of the given
+        key sizes (by default, the sizes of the factor graph).
+
+        If out is given, it is a list of arrays (one for each maxclique) where
+        the values are stored.
 
+        """
+
+        if out is not None:
+            for (factors, groups, y) in zip(
+                    self.maxclique_to_factors,
+                    self.evaluation_products,
+                    out
+            ):
+                if len(factors) > 0:
+                    run_product(take(xs, factors), groups, distributive_law, out=y)
+                else:
+                    np.copyto(y, distributive_law.ones((), dtype=y.dtype))
+            return out
+
+        sizes = self.factor_graph.sizes if sizes is None else sizes
         return [
-            einsum(
+            run_product(
                 take(xs, factors),
-                take(self.factor_graph.factors, factors),
-                maxclique
+                groups,
+                distributive_law
+            ) if len(factors) > 0 else
+            distributive_law.ones(
+                tuple(sizes[key] for key in maxclique),
+                dtype=np.result_type(xs[0]) if len(xs) > 0 else None
             )
-            for (factors, maxclique) in zip(
-                    maxclique_to_factors,
-                    self.maxcliques
+            for (factors, maxclique, groups) in zip(
+                    self.maxclique_to_factors,
+                    self.maxcliques,
+                    self.evaluation_products
             )
         ]
 
 
-    def marginalize(self, ys):
+    def marginalize(self, ys, distributive_law=bp.sum_product, tile_size=None):
         """Marginalize results for maxcliques to results for factors
 
         This needs to be done because each maxclique may contain multiple
@@ -240,34 +710,37 @@ class CliqueGraph():
         ys : A list of arrays containing the result (e.g., consistent clique
              potentials) for each maxclique.
 
+        distributive_law : The distributive law used in marginalization.
+
+        tile_size : If given, the maxclique arrays are marginalized in tiles
+                    of at most this many bytes (see `SumProduct.project_chunked`).
+
         Outputs
         -------
         xs : A list of arrays containing the result for each factor.
 
         """
 
-        # This tells which maxclique to use for each factor
-        self.factor_to_maxclique
-
-        # This tells the keys in each factor
-        self.factor_graph.factors
-
-        # This tells the keys in each maxclique
-        self.maxcliques
-
-        # Now, use my custom einsum to marginalize, something like (didn't test
-        # this out):
-        #
-        # FIXME: This is most likely slightly incorrect as I didn't test it.
+        # The einsums have been compiled once from the keys of each factor
+        # and the maxclique it belongs to. The factor keys are a subset of the
+        # maxclique keys, so the auxiliary axes of run_einsum aren't needed
+        # in tiled marginalization.
         return [
-            einsum(
+            run_einsum(
                 [ys[maxclique]],
-                [self.maxcliques[maxclique]],
-                factor_keys
+                compiled,
+                distributive_law
             )
-            for (factor_keys, maxclique) in zip(
-                    self.factor_graph.factors,
-                    self.factor_to_maxclique
+            if tile_size is None else
+            distributive_law.project_chunked(
+                ys[maxclique],
+                compiled[1][0],
+                compiled[2],
+                tile_slices(ys[maxclique], compiled[1][0], compiled[2], tile_size)
+            )
+            for (maxclique, compiled) in zip(
+                    self.factor_to_maxclique,
+                    self.marginalization_einsums
             )
         ]
 
@@ -291,41 +764,720 @@ class JunctionTree():
     # The underlying triangulated clique graph
     clique_tree = attr.ib()
 
+    # Compiled message passing schedule (see bp.compile_schedule)
+    schedule = attr.ib(init=False, eq=False, repr=False)
 
-    def propagate(self, xs):
-        """Run belief propagation on the Junction tree."""
+    # The tree structure as flat index arrays
+    array_tree = attr.ib(init=False, eq=False, repr=False)
 
-        # Let's fix the distributive law for now, as there are no other
-        # distributive laws implemented currently. Probably other distributive
-        # laws will require some changes in other places that we haven't
-        # thought about yet, that is, some code may implicitly assume
-        # sum-product distributive law.
-        distributive_law = bp.sum_product
+    # Clique and separator buffers reused in in-place propagation
+    buffers = attr.ib(init=False, eq=False, repr=False, factory=dict)
 
-        # Evaluate maximum cliques based on factor values
-        maxclique_values = self.clique_tree.evaluate(xs)
+    # Compiled messages by (source clique ID, target clique ID)
+    messages = attr.ib(init=False, eq=False, repr=False)
+
+    # Smallest maxclique containing each key
+    key_to_maxclique = attr.ib(init=False, eq=False, repr=False)
+
+    # Messages grouped into levels of independent tasks (see bp.compile_levels)
+    levels = attr.ib(init=False, eq=False, repr=False)
+
+
+    def __getstate__(self):
+        # The buffers of in-place propagation are not part of the compiled
+        # tree so they are not pickled
+        return {**self.__dict__, "buffers": {}}
+
+
+    @array_tree.default
+    def _create_array_tree(self):
+        return ArrayTree.from_tree(
+            self.tree,
+            len(self.clique_tree.maxcliques)
+        )
+
+
+    @schedule.default
+    def _compile_schedule(self):
+        return bp.compile_schedule(
+            self.tree,
+            self.clique_tree.maxcliques + self.separators
+        )
+
+
+    @messages.default
+    def _index_messages(self):
+        return {
+            (message[0], message[2]): message
+            for message in self.schedule
+        }
+
+
+    @levels.default
+    def _compile_levels(self):
+        return bp.compile_levels(self.schedule, self.array_tree._depths)
 
-        # Initialize separator values
+
+    @key_to_maxclique.default
+    def _find_key_maxcliques(self):
+        key_to_maxclique = {}
+        for (c_ix, maxclique) in enumerate(self.clique_tree.maxcliques):
+            for key in maxclique:
+                other = key_to_maxclique.get(key)
+                if other is None or len(maxclique) < len(self.clique_tree.maxcliques[other]):
+                    key_to_maxclique[key] = c_ix
+        return key_to_maxclique
+
+
+    def calibrate(self, xs, distributive_law=bp.sum_product, evidence=None, inplace=False, algorithm="hugin", workers=None, scratch_dir=None, tile_size=None):
+        """Compute consistent maxclique potentials from factor values.
+
+        Returns a list of arrays, one for each maxclique (see `propagate`).
+
+        """
+
+        if algorithm not in ("hugin", "shafer_shenoy"):
+            raise ValueError("Unknown propagation algorithm: {0}".format(algorithm))
+        if inplace and algorithm != "hugin":
+            raise ValueError("In-place propagation is supported only by Hugin")
+        if workers is not None and algorithm != "hugin":
+            raise ValueError("Parallel propagation is supported only by Hugin")
+        blocked = scratch_dir is not None or tile_size is not None
+        if blocked and (algorithm != "hugin" or workers is not None):
+            raise ValueError(
+                "Blocked and out-of-core propagation are supported only by "
+                "sequential Hugin"
+            )
+        if inplace and scratch_dir is not None:
+            raise ValueError(
+                "Out-of-core propagation uses memory-mapped cliques instead of "
+                "in-place buffers"
+            )
+
+        (xs, sizes) = self._observe(xs, evidence)
+
+        if scratch_dir is not None or (blocked and not inplace):
+            return self._calibrate_blocked(
+                xs,
+                distributive_law,
+                sizes,
+                tile_size or DEFAULT_TILE_SIZE,
+                scratch_dir
+            )
+        if inplace:
+            return self._calibrate_inplace(
+                xs,
+                distributive_law,
+                sizes,
+                workers,
+                tile_size
+            )
+
+        if algorithm == "shafer_shenoy":
+            # Messages are stored instead of separator potentials
+            maxclique_values = self.clique_tree.evaluate(xs, distributive_law, sizes)
+            ys = bp.run_shafer_shenoy(
+                self.schedule,
+                maxclique_values + len(self.separators) * [None],
+                distributive_law
+            )
+            return ys[:len(maxclique_values)]
+
+        # The message schedule has been compiled when the tree was created so
+        # only the numeric kernels are run here.
+        ys = self._run_schedule(
+            self._initialize(xs, distributive_law, sizes),
+            distributive_law,
+            workers
+        )
+
+        return ys[:len(self.clique_tree.maxcliques)]
+
+
+    def _run_schedule(self, values, distributive_law, workers, scratch=None, tile_size=None):
+        """Pass the messages of the schedule (on workers threads if given)."""
+
+        if tile_size is not None:
+            return bp.run_schedule_chunked(
+                self.schedule,
+                values,
+                scratch,
+                distributive_law,
+                tile_size
+            )
+        if workers is None:
+            return (
+                bp.run_schedule(self.schedule, values, distributive_law)
+                if scratch is None else
+                bp.run_schedule_inplace(self.schedule, values, scratch, distributive_law)
+            )
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return bp.run_levels(
+                self.levels,
+                values,
+                distributive_law,
+                executor,
+                scratch
+            )
+
+
+    def _observe(self, xs, evidence):
+        """Slice observed axes from factor values.
+
+        Returns the sliced factor values and the key sizes of the sliced
+        potentials.
+
+        """
+
+        # Observed axes are sliced out of the factors so that the cliques and
+        # separators contain only the observed values (size one axes)
+        factors = self.clique_tree.factor_graph.factors
         sizes = self.clique_tree.factor_graph.sizes
+        if evidence:
+            unknown = set(evidence).difference(sizes)
+            if unknown:
+                raise ValueError("Unknown observed keys: {0}".format(unknown))
+            xs = [
+                observe(x, x_keys, evidence)
+                for (x, x_keys) in zip(xs, factors)
+            ]
+            sizes = {**sizes, **{key: 1 for key in evidence}}
+        return (xs, sizes)
+
+
+    def _initialize(self, xs, distributive_law, sizes):
+        """Initial maxclique and separator potentials (as in node list)."""
+
+        # Evaluate maximum cliques based on factor values
+        maxclique_values = self.clique_tree.evaluate(xs, distributive_law, sizes)
+
+        # Initialize separator values (with the same precision as cliques)
+        dtype = functools.reduce(
+            np.promote_types,
+            [np.result_type(value) for value in maxclique_values],
+            np.dtype(np.float16)
+        )
         separator_values= [
-            np.ones(tuple(sizes[key] for key in separator))
+            distributive_law.ones(
+                tuple(sizes[key] for key in separator),
+                dtype=dtype
+            )
             for separator in self.separators
         ]
 
         # Node list is a concatenation of maxcliques and separators
-        values = maxclique_values + separator_values
+        return maxclique_values + separator_values
 
-        # FIXME: There is some argument missing and not sure if these arguments
-        # match what the function expects.
-        ys = bp.hugin(
-            self.tree,
-            self.clique_tree.maxcliques + self.separators,
+
+    def _layout(self, xs, sizes):
+        """Shapes and type of the potentials in in-place propagation."""
+
+        factors = self.clique_tree.factor_graph.factors
+
+        # All potentials get the full (broadcast) batch shape and key sizes
+        # because messages are absorbed in place. Keys not in any factor keep
+        # axes of size one as in clique evaluation.
+        batch_shape = np.broadcast_shapes(
+            *[
+                np.shape(x)[:np.ndim(x)-len(x_keys)]
+                for (x, x_keys) in zip(xs, factors)
+            ]
+        )
+        dtype = functools.reduce(
+            np.promote_types,
+            [np.result_type(x) for x in xs],
+            np.dtype(np.float16)
+        )
+        factor_keys = set(key for x_keys in factors for key in x_keys)
+        shapes = [
+            batch_shape + tuple(
+                sizes[key] if key in factor_keys else 1
+                for key in node
+            )
+            for node in self.clique_tree.maxcliques + self.separators
+        ]
+        return (shapes, dtype)
+
+
+    def _calibrate_inplace(self, xs, distributive_law, sizes, workers=None, tile_size=None):
+        """Calibrate in the buffers of the tree (see `calibrate`)."""
+
+        maxcliques = self.clique_tree.maxcliques
+        (shapes, dtype) = self._layout(xs, sizes)
+
+        # Allocate the buffers only when the shapes or the type change
+        if self.buffers.get("layout") != (shapes, dtype):
+            self.buffers.clear()
+            self.buffers["layout"] = (shapes, dtype)
+            self.buffers["values"] = [
+                np.empty(shape, dtype=dtype)
+                for shape in shapes
+            ]
+            self.buffers["scratch"] = len(maxcliques) * [None] + [
+                np.empty(shape, dtype=dtype)
+                for shape in shapes[len(maxcliques):]
+            ]
+        values = self.buffers["values"]
+
+        self.clique_tree.evaluate(
+            xs,
+            distributive_law,
+            out=values[:len(maxcliques)]
+        )
+        for separator_value in values[len(maxcliques):]:
+            np.copyto(separator_value, distributive_law.ones((), dtype=dtype))
+
+        ys = self._run_schedule(
             values,
-            distributive_law
+            distributive_law,
+            workers,
+            self.buffers["scratch"],
+            tile_size
+        )
+
+        return ys[:len(maxcliques)]
+
+
+    def _calibrate_blocked(self, xs, distributive_law, sizes, tile_size, scratch_dir=None):
+        """Calibrate in tiles, in memory-mapped cliques if scratch_dir is given."""
+
+        num_cliques = len(self.clique_tree.maxcliques)
+        (shapes, dtype) = self._layout(xs, sizes)
+
+        # The files are removed when the memory maps are closed
+        def __memmap(shape):
+            with tempfile.TemporaryFile(dir=scratch_dir) as f:
+                return np.memmap(f, dtype=dtype, mode="w+", shape=shape)
+
+        values = [
+            np.empty(shape, dtype=dtype) if scratch_dir is None else __memmap(shape)
+            for shape in shapes[:num_cliques]
+        ] + [
+            distributive_law.ones(shape, dtype=dtype)
+            for shape in shapes[num_cliques:]
+        ]
+        scratch = num_cliques * [None] + [
+            np.empty(shape, dtype=dtype)
+            for shape in shapes[num_cliques:]
+        ]
+
+        self.clique_tree.evaluate(
+            xs,
+            distributive_law,
+            out=values[:num_cliques]
+        )
+        ys = bp.run_schedule_chunked(
+            self.schedule,
+            values,
+            scratch,
+            distributive_law,
+            tile_size
+        )
+
+        return ys[:num_cliques]
+
+
+    def propagate(self, xs, distributive_law=bp.sum_product, evidence=None, inplace=False, algorithm="hugin", workers=None, scratch_dir=None, tile_size=None):
+        """Run belief propagation on the Junction tree.
+
+        Each array in xs may have leading batch axes in addition to the axes
+        of the factor keys. All scenarios in the batch are then propagated in
+        one pass and the batch axes (broadcast over all factors) are kept in
+        the results.
+
+        The distributive law defines how the factor values are combined and
+        marginalized. With `bp.log_sum_product`, xs are log-potentials and
+        the results are log-marginals. The floating point type of the inputs
+        is kept, so single precision inputs give single precision results.
+
+        Evidence is a dictionary from observed keys to their observed values
+        (indices). The observed axes are sliced out of the potentials before
+        message passing, so the compiled tree is reused and less arithmetic
+        is done. In the results, the axes of observed keys have size one.
+
+        With inplace=True, the clique and separator potentials are stored in
+        buffers which are allocated once for the tree (and again only if the
+        shapes of xs change) and messages are absorbed in place. This avoids
+        allocations in repeated propagations but the tree must not be used for
+        in-place propagation from multiple threads at the same time.
+
+        The algorithm is either "hugin" or "shafer_shenoy". Shafer-Shenoy
+        algorithm stores messages instead of updating clique potentials and
+        doesn't divide, which avoids numerical problems with (nearly) zero
+        separator potentials.
+
+        With workers given, the messages between independent subtrees are
+        passed concurrently on a pool of that many threads. The tree is
+        processed level by level, so wide trees with large cliques benefit
+        the most. Only Hugin algorithm supports parallel propagation.
+
+        With tile_size (bytes) given, messages are projected and absorbed in
+        tiles of the clique potentials split along the axes of the keys not
+        in the separator. This bounds the temporary memory of each message
+        (e.g., in log space) and improves cache locality for large cliques.
+
+        With scratch_dir given, the maxclique potentials are stored in
+        memory-mapped temporary files in that directory, so that the total
+        size of the cliques may exceed the memory. Messages are passed in
+        tiles (8 MB by default). Separator potentials and the results are
+        kept in memory. Out-of-core propagation can't be combined with
+        inplace=True.
+
+        """
+
+        ys = self.calibrate(
+            xs,
+            distributive_law,
+            evidence,
+            inplace,
+            algorithm,
+            workers,
+            scratch_dir,
+            tile_size
         )
 
         # The return result should be marginalized to the factors. That is, the
         # output list and the arrays inside it have the same length and shapes
         # as xs. That marginalization function should be provided by
         # CliqueGraph.
-        return self.clique_tree.marginalize(ys)
+        results = self.clique_tree.marginalize(
+            ys,
+            distributive_law,
+            DEFAULT_TILE_SIZE if scratch_dir is not None and tile_size is None else tile_size
+        )
+        if inplace or scratch_dir is not None or tile_size is not None:
+            # results must not be views of the buffers or memory maps
+            results = [np.array(x) if x.base is not None else x for x in results]
+        return results
+
+
+    def propagate_many(self, xs, evidence, distributive_law=bp.sum_product, processes=None, return_metrics=False):
+        """Propagate the same factor values with many sets of evidence.
+
+        The evidence sets (dictionaries as in `propagate`, or None) are
+        distributed over a pool of worker processes. The compiled tree and the
+        distributive law are sent once to each worker and the factor values
+        are placed once in shared memory, so that only the evidence and the
+        results are passed for each scenario. The results are returned in the
+        order of the evidence sets. Shared memory needs Python 3.8 or later.
+
+        The number of processes defaults to the number of CPUs. With
+        return_metrics=True, a dictionary of throughput metrics is returned
+        as well: the number of scenarios and processes, seconds spent in
+        starting the pool and in propagation, and scenarios per second.
+
+        """
+
+        evidence = list(evidence)
+        processes = processes or multiprocessing.cpu_count()
+
+        start = time.perf_counter()
+        (shm, layout) = share_arrays(xs)
+        try:
+            with multiprocessing.Pool(
+                    processes,
+                    initializer=_initialize_worker,
+                    initargs=(self, distributive_law, shm.name, layout)
+            ) as pool:
+                started = time.perf_counter()
+                results = pool.map(
+                    _propagate_worker,
+                    evidence,
+                    chunksize=max(1, len(evidence) // (4 * processes))
+                )
+                finished = time.perf_counter()
+        finally:
+            shm.close()
+            shm.unlink()
+
+        if not return_metrics:
+            return results
+        metrics = {
+            "scenarios": len(evidence),
+            "processes": processes,
+            "setup_seconds": started - start,
+            "seconds": finished - started,
+            "scenarios_per_second": len(evidence) / max(finished - started, 1e-9),
+        }
+        return (results, metrics)
+
+
+    def find_map_assignment(self, xs, evidence=None):
+        """Find the most probable joint assignment of all keys.
+
+        The potentials are propagated with the max-product distributive law
+        and the assignment is decoded from the max-marginals by a traceback
+        from the root. Returns a dictionary from each key to the index of its
+        most probable value (an array of indices if xs have batch axes).
+
+        Observed keys (see `propagate`) are assigned their observed values.
+
+        """
+
+        assignment = bp.find_map_assignment(
+            self.array_tree.order,
+            self.clique_tree.maxcliques,
+            self.calibrate(xs, bp.max_product, evidence)
+        )
+        if evidence:
+            # indices of the sliced axes are relative to the observed values
+            assignment = {
+                key: ind + evidence.get(key, 0)
+                for (key, ind) in assignment.items()
+            }
+        return assignment
+
+
+    def session(self, xs, distributive_law=bp.sum_product):
+        """Start a session for entering evidence incrementally.
+
+        The factor values are propagated once and evidence can then be
+        added, changed and retracted one key at a time (see `Session`).
+
+        """
+
+        (xs, sizes) = self._observe(xs, None)
+        return Session(
+            junction_tree=self,
+            prior=bp.run_schedule(
+                self.schedule,
+                self._initialize(xs, distributive_law, sizes),
+                distributive_law
+            ),
+            distributive_law=distributive_law
+        )
+
+
+    def query(self, xs, keys, evidence=None, distributive_law=bp.sum_product):
+        """Compute the marginals of the given keys only.
+
+        Messages are collected from the whole tree toward a maxclique
+        containing the first key, as all factors affect the marginals, but
+        they are distributed only within the smallest subtree containing the
+        maxcliques of the query keys. Thus, the cost of distribution and
+        marginalization depends only on the queried part of the tree.
+
+        Returns a list of arrays, one for each key, which equal the
+        corresponding marginals of the results of `propagate` (including
+        batch axes and the evidence, see `propagate`). An empty query gives
+        an empty list without propagation.
+
+        """
+
+        # Maxcliques of the queried keys (the first one as the root)
+        unknown = set(keys).difference(self.key_to_maxclique)
+        if unknown:
+            raise ValueError("Unknown query keys: {0}".format(unknown))
+        if len(keys) == 0:
+            return []
+        query_cliques = [self.key_to_maxclique[key] for key in keys]
+        tree = self.array_tree.reroot(query_cliques[0])
+
+        # Smallest subtree containing the query cliques (i.e., the union of
+        # the paths from the query cliques to the root)
+        subtree = set([tree.root])
+        for c_ix in query_cliques:
+            while c_ix not in subtree:
+                subtree.add(c_ix)
+                c_ix = int(tree.parents[c_ix])
+
+        # Collect from the whole tree in post-order and distribute only within
+        # the subtree in pre-order
+        schedule = [
+            self.messages[(c_ix, tree.parents[c_ix])]
+            for c_ix in tree.order[:0:-1]
+        ] + [
+            self.messages[(tree.parents[c_ix], c_ix)]
+            for c_ix in tree.order[1:]
+            if c_ix in subtree
+        ]
+
+        (xs, sizes) = self._observe(xs, evidence)
+        values = self._initialize(xs, distributive_law, sizes)
+
+        ys = bp.run_schedule(schedule, values, distributive_law)
+
+        return [
+            einsum(
+                [ys[c_ix]],
+                [self.clique_tree.maxcliques[c_ix]],
+                [key],
+                distributive_law
+            )
+            for (key, c_ix) in zip(keys, query_cliques)
+        ]
+
+
+@attr.s(frozen=False)
+class Session():
+    """
+    Calibrated potentials of a Junction tree with incrementally entered
+    evidence.
+
+    Observed values are entered by setting the potentials of the other values
+    to zero in a maxclique containing the key. Only the cliques on the path
+    from an up-to-date clique are updated when a marginal is needed, so the
+    cost of an observation depends on the length of the path instead of the
+    size of the tree. Unlike in `JunctionTree.propagate`, the axes of observed
+    keys are not sliced, that is, the potentials are zero for the other values.
+
+    """
+
+    # The Junction tree
+    junction_tree = attr.ib()
+
+    # Calibrated maxclique and separator potentials without evidence
+    prior = attr.ib(repr=False)
+
+    # Distributive law used in propagation
+    distributive_law = attr.ib()
+
+    # Current maxclique and separator potentials
+    potentials = attr.ib(init=False, repr=False)
+
+    # Observed value of each observed key
+    evidence = attr.ib(init=False, factory=dict)
+
+    # Maxcliques that are consistent with the evidence. They form a connected
+    # subtree which contains the anchor clique, i.e., the clique where
+    # evidence was last entered.
+    fresh = attr.ib(init=False, repr=False)
+    anchor = attr.ib(init=False, repr=False)
+
+
+    @potentials.default
+    def _copy_prior(self):
+        return [value.copy() for value in self.prior]
+
+
+    @fresh.default
+    def _all_fresh(self):
+        return set(range(len(self.junction_tree.clique_tree.maxcliques)))
+
+
+    @anchor.default
+    def _root_anchor(self):
+        return self.junction_tree.array_tree.root
+
+
+    @property
+    def dirty(self):
+        """Maxcliques that are not consistent with the evidence."""
+        return set(range(len(self.junction_tree.clique_tree.maxcliques))) - self.fresh
+
+
+    def set_evidence(self, key, value):
+        """Observe (or change the observed) value of a key."""
+
+        sizes = self.junction_tree.clique_tree.factor_graph.sizes
+        if key not in self.junction_tree.key_to_maxclique:
+            raise ValueError("Unknown observed key: {0}".format(key))
+        if not 0 <= value < sizes[key]:
+            raise ValueError(
+                "Observed value {0} of key {1} out of range".format(value, key)
+            )
+
+        if key in self.evidence:
+            if self.evidence[key] == value:
+                return
+            # zeroed values can't be recovered so start again from the prior
+            self.evidence[key] = value
+            self._reset()
+        else:
+            self.evidence[key] = value
+            self._enter(key, value)
+
+
+    def retract_evidence(self, key):
+        """Remove the observation of a key."""
+        del self.evidence[key]
+        self._reset()
+
+
+    def marginal(self, key):
+        """Marginal of a key given the evidence."""
+
+        c_ix = self.junction_tree.key_to_maxclique[key]
+        self._update(c_ix)
+        return einsum(
+            [self.potentials[c_ix]],
+            [self.junction_tree.clique_tree.maxcliques[c_ix]],
+            [key],
+            self.distributive_law
+        )
+
+
+    def marginals(self):
+        """Results for factors given the evidence (see `propagate`)."""
+
+        # pass messages from the anchor to all cliques that are not fresh
+        tree = self.junction_tree.array_tree.reroot(self.anchor)
+        bp.run_schedule(
+            [
+                self.junction_tree.messages[(tree.parents[c_ix], c_ix)]
+                for c_ix in tree.order[1:]
+                if c_ix not in self.fresh
+            ],
+            self.potentials,
+            self.distributive_law
+        )
+        self.fresh = self._all_fresh()
+        return self.junction_tree.clique_tree.marginalize(
+            self.potentials[:len(self.fresh)],
+            self.distributive_law
+        )
+
+
+    def _update(self, c_ix):
+        """Make a maxclique consistent with the evidence.
+
+        Messages are passed along the path from the closest fresh clique.
+
+        """
+
+        if c_ix in self.fresh:
+            return
+
+        # the fresh cliques are a connected subtree containing the anchor
+        path = self.junction_tree.array_tree.path(c_ix, self.anchor)
+        path = path[:next(i for (i, p) in enumerate(path) if p in self.fresh) + 1]
+        path = path[::-1]
+        bp.run_schedule(
+            [
+                self.junction_tree.messages[(source, target)]
+                for (source, target) in zip(path[:-1], path[1:])
+            ],
+            self.potentials,
+            self.distributive_law
+        )
+        self.fresh.update(path)
+
+
+    def _enter(self, key, value):
+        """Enter an observation in a maxclique containing the key."""
+
+        c_ix = self.junction_tree.key_to_maxclique[key]
+        self._update(c_ix)
+
+        # set the potential of the other values to zero
+        maxclique = self.junction_tree.clique_tree.maxcliques[c_ix]
+        potential = self.potentials[c_ix]
+        axis = maxclique.index(key) - len(maxclique)
+        others = np.arange(np.shape(potential)[axis]) != value
+        potential[(Ellipsis, others) + (-axis-1) * (slice(None),)] = (
+            self.distributive_law.zeros((), dtype=potential.dtype)
+        )
+
+        # the other cliques may be inconsistent with this clique now
+        self.fresh = set([c_ix])
+        self.anchor = c_ix
+
+
+    def _reset(self):
+        """Start from the prior and enter the evidence again."""
+        self.potentials = self._copy_prior()
+        self.fresh = self._all_fresh()
+        self.anchor = self._root_anchor()
+        for (key, value) in self.evidence.items():
+            self._enter(key, value)
@@ -1,21 +1,607 @@
 import numpy as np
+import functools
+import itertools
+
+
+def parse_einsum_args(args):
+    """
+    Parse einsum arguments given in sublist format
+
+    Input:
+    ------
+
+    Arguments (array1, keys1, ..., arrayN, keysN, output_keys)
+
+    Output:
+    -------
+
+    List of arrays
+
+    List of input keys for each array
+
+    Output keys
+
+    """
+
+    if len(args) % 2 == 0:
+        raise ValueError("Output keys must be given explicitly")
+    return (list(args[:-1:2]), list(args[1:-1:2]), args[-1])
+
+
+def broadcast_shape(*shapes):
+    """Shape of arrays of the given shapes broadcast against each other.
+
+    Unlike numpy.broadcast_shapes, this isn't limited to 32 dimensions.
+
+    """
+    ndim = max([len(shape) for shape in shapes] + [0])
+    shapes = [(1,) * (ndim - len(shape)) + tuple(shape) for shape in shapes]
+    result = []
+    for sizes in zip(*shapes):
+        other = set(sizes).difference([1])
+        if len(other) > 1:
+            raise ValueError(
+                "Shapes can't be broadcast together: {0}".format(shapes)
+            )
+        result.append(other.pop() if other else 1)
+    return tuple(result)
+
+
+def align(x, keys, all_keys):
+    """
+    View of array with axes ordered as in all_keys
+
+    Keys not in the array get a new axis of size one, so the aligned arrays
+        of different keys broadcast against each other. Leading axes not
+        covered by keys (batch axes) are kept as leading axes.
+
+    Input:
+    ------
+
+    Array
+
+    Keys of the array axes (may start with Ellipsis)
+
+    Keys of the output axes (without Ellipsis)
+
+    Output:
+    -------
+
+    Array with len(all_keys) trailing axes
+
+    """
+
+    x = np.asarray(x)
+    keys = [key for key in keys if key is not Ellipsis]
+    num_batch = np.ndim(x) - len(keys)
+    axes = {key: num_batch + i for (i, key) in enumerate(keys)}
+    x = np.transpose(
+        x,
+        list(range(num_batch)) + [axes[key] for key in all_keys if key in axes]
+    )
+    sizes = iter(np.shape(x)[num_batch:])
+    return np.reshape(
+        x,
+        np.shape(x)[:num_batch] + tuple(
+            next(sizes) if key in axes else 1
+            for key in all_keys
+        )
+    )
+
+
+def compile_alignment(x_keys, y_keys):
+    """Plan the alignment of array axes to the given keys.
+
+    Returns the permutation of the axes of x_keys to the order of y_keys (None
+    if no permutation is needed) and an index which adds axes of size one for
+    the keys not in x_keys. See `run_alignment`.
+
+    """
+    perm = [list(x_keys).index(key) for key in y_keys if key in x_keys]
+    return (
+        None if perm == sorted(perm) else perm,
+        (Ellipsis,) + tuple(
+            slice(None) if key in x_keys else None
+            for key in y_keys
+        )
+    )
+
+
+def run_alignment(x, alignment):
+    """View of an array aligned with `compile_alignment`.
+
+    Leading batch axes are kept.
+
+    """
+    (perm, index) = alignment
+    x = np.asarray(x)
+    if perm is not None:
+        num_batch = np.ndim(x) - len(perm)
+        x = np.transpose(
+            x,
+            list(range(num_batch)) + [num_batch + i for i in perm]
+        )
+    return x[index]
+
+
+def chunk_slices(shape, axes, max_size):
+    """Split an array into chunks along the given axes.
+
+    The axes are split in the given order until each chunk has at most
+    max_size elements (or all the given axes have been split to length one).
+    Yields an index (a tuple of slices) for each chunk.
+
+    """
+    size = int(np.prod(shape))
+    steps = {}
+    for axis in axes:
+        if size <= max_size:
+            break
+        rest = size // shape[axis]
+        steps[axis] = max(1, max_size // max(rest, 1))
+        size = rest * steps[axis]
+    return itertools.product(
+        *[
+            [slice(i, i + steps[axis]) for i in range(0, length, steps[axis])]
+            if axis in steps else
+            [slice(None)]
+            for (axis, length) in enumerate(shape)
+        ]
+    )
+
+
+def tile_slices(x, x_keys, kept_keys, tile_size):
+    """Split an array into tiles of at most tile_size bytes (if possible).
+
+    The keys are mapped keys with a leading Ellipsis for batch axes. Only the
+    axes of the keys not in kept_keys are split, so that the marginals of the
+    tiles over the other keys have the shape of the marginal of x.
+
+    """
+    num_batch = np.ndim(x) - len(x_keys) + 1
+    return chunk_slices(
+        np.shape(x),
+        [
+            num_batch + i
+            for (i, key) in enumerate(x_keys[1:])
+            if key not in kept_keys
+        ],
+        max(1, tile_size // np.dtype(x.dtype).itemsize)
+    )
+
+
+# numpy.einsum accepts integer keys in range(52) in sublist format
+EINSUM_MAX_LABELS = 52
+
+
+@functools.lru_cache(maxsize=4096)
+def map_sublist_keys(keys, sub_keys):
+    """Map keys locally to integers accepted by einsum.
+
+    The key at position i of keys is mapped to i and sub_keys (a subset of
+    keys) accordingly. Both mapped tuples start with an Ellipsis for batch
+    axes. The mappings are cached because the same cliques and separators are
+    mapped again in every propagation.
+
+    """
+    m_keys = {k: i for (i, k) in enumerate(keys)}
+    return (
+        (Ellipsis,) + tuple(range(len(keys))),
+        (Ellipsis,) + tuple(m_keys[k] for k in sub_keys)
+    )
+
+
+def exceeds_einsum_labels(keys):
+    """Test whether sublist keys are out of the range accepted by einsum."""
+    return any(
+        key is not Ellipsis and not 0 <= key < EINSUM_MAX_LABELS
+        for key in keys
+    )
+
+
+def tensordot_contract(args, out=None):
+    """
+    Sum-product contraction of numpy.einsum (in sublist format) for any
+        number of keys
+
+    The operands are contracted pairwise with batched matrix products: the
+        keys of both operands still needed after the product are stacked
+        into one batch axis, the keys summed out into one inner axis and the
+        other keys of each operand into one row or column axis. Thus, each
+        product has three axes regardless of the number of keys. Keys
+        which are only in one operand and not needed later are summed out
+        before the product.
+
+    Input:
+    ------
+
+    Arguments (array1, keys1, ..., arrayN, keysN, output_keys)
+
+    Optional array where the result is stored
+
+    Output:
+    -------
+
+    Array with leading batch axes and axes for the output keys
+
+    """
+
+    (xs, xs_keys, y_keys) = parse_einsum_args(args)
+
+    # Leading batch axes (aligned from the right) get keys of their own
+    xs = [np.asarray(x) for x in xs]
+    xs_keys = [[key for key in keys if key is not Ellipsis] for keys in xs_keys]
+    num_batch = max(
+        [np.ndim(x) - len(keys) for (x, keys) in zip(xs, xs_keys)] + [0]
+    )
+    batch_keys = [(Ellipsis, i) for i in range(num_batch)]
+    operands = [
+        (x, batch_keys[num_batch-np.ndim(x)+len(keys):] + keys)
+        for (x, keys) in zip(xs, xs_keys)
+    ]
+    out_keys = (batch_keys if Ellipsis in y_keys else []) + [
+        key for key in y_keys if key is not Ellipsis
+    ]
+
+    def __sum_out(x, keys, needed):
+        axes = tuple(i for (i, key) in enumerate(keys) if key not in needed)
+        if len(axes) == 0:
+            return (x, keys)
+        return (np.sum(x, axis=axes), [key for key in keys if key in needed])
+
+    def __product(x1, keys1, x2, keys2, needed):
+        # Broadcast axes of size one are summed out of the operand which has
+        # them (the sum of a single element is the element)
+        sizes1 = dict(zip(keys1, np.shape(x1)))
+        sizes2 = dict(zip(keys2, np.shape(x2)))
+        shared = [key for key in keys1 if key in sizes2]
+        (x1, keys1) = __sum_out(
+            x1,
+            keys1,
+            needed.union(keys2).difference(
+                [key for key in shared if sizes1[key] == 1 and sizes2[key] > 1]
+            )
+        )
+        (x2, keys2) = __sum_out(
+            x2,
+            keys2,
+            needed.union(keys1).difference(
+                [key for key in shared if sizes2[key] == 1 and sizes1[key] > 1]
+            )
+        )
+
+        batch = [key for key in keys1 if key in keys2 and key in needed]
+        inner = [key for key in keys1 if key in keys2 and key not in needed]
+        rows = [key for key in keys1 if key not in keys2]
+        cols = [key for key in keys2 if key not in keys1]
+        sizes = dict(zip(keys1, np.shape(x1)))
+        sizes.update(zip(keys2, np.shape(x2)))
+
+        def __block(x, keys, groups):
+            x = np.transpose(x, [keys.index(key) for group in groups for key in group])
+            return np.reshape(
+                x,
+                [int(np.prod([sizes[key] for key in group])) for group in groups]
+            )
+
+        y = np.matmul(
+            __block(x1, keys1, [batch, rows, inner]),
+            __block(x2, keys2, [batch, inner, cols])
+        )
+        return (
+            np.reshape(y, [sizes[key] for key in batch + rows + cols]),
+            batch + rows + cols
+        )
+
+    while len(operands) > 1:
+        # Contract the first operand with the one sharing most keys with it
+        (x1, keys1) = operands.pop(0)
+        j = max(
+            range(len(operands)),
+            key=lambda j: len(set(keys1).intersection(operands[j][1]))
+        )
+        (x2, keys2) = operands.pop(j)
+        needed = set(out_keys).union(*[keys for (_, keys) in operands])
+        operands.append(__product(x1, keys1, x2, keys2, needed))
+
+    (y, keys) = __sum_out(*operands[0], set(out_keys))
+    # Output keys not in any operand get axes of size one
+    sizes = dict(zip(keys, np.shape(y)))
+    y = np.reshape(
+        np.transpose(y, [keys.index(key) for key in out_keys if key in sizes]),
+        [sizes.get(key, 1) for key in out_keys]
+    )
+    if out is None:
+        return y
+    np.copyto(out, y)
+    return out
+
+
+def einsum(*args, **kwargs):
+    """
+    numpy.einsum which also accepts more keys than numpy supports
+
+    Contractions in sublist format with keys out of the range of numpy.einsum
+        are computed with tensordot_contract.
+
+    """
+
+    if not isinstance(args[0], str) and any(
+            exceeds_einsum_labels(keys) for keys in args[1::2]
+    ):
+        return tensordot_contract(args, out=kwargs.get("out"))
+    return np.einsum(*args, **kwargs)
+
+
+def logsumexp(x, axes):
+    """
+    Compute log(sum(exp(x))) over the given axes (keeping the axes with size
+        one) by shifting with the maximum to avoid underflow and overflow
+
+    """
+
+    if len(axes) == 0:
+        return x
+    m = np.max(x, axis=axes, keepdims=True)
+    # avoid nan when all values are -inf
+    m = np.where(np.isfinite(m), m, 0)
+    with np.errstate(divide="ignore"):
+        return np.log(np.sum(np.exp(x - m), axis=axes, keepdims=True)) + m
+
+
+def contract(args, product, marginal, out=None):
+    """
+    Generalization of numpy.einsum (in sublist format) to other products
+        and marginalizations
+
+    Input:
+    ------
+
+    Arguments (array1, keys1, ..., arrayN, keysN, output_keys)
+
+    Elementwise product of two arrays (e.g., numpy.multiply)
+
+    Marginalization over given axes keeping the axes with size one
+        (e.g., logsumexp)
+
+    Optional array where the result is stored
+
+    Output:
+    -------
+
+    Array with leading batch axes and axes for the output keys
+
+    """
+
+    (xs, xs_keys, y_keys) = parse_einsum_args(args)
+    out_keys = [key for key in y_keys if key is not Ellipsis]
+    all_keys = out_keys + list(
+        dict.fromkeys(
+            [
+                key
+                for keys in xs_keys
+                for key in keys
+                if key is not Ellipsis and key not in out_keys
+            ]
+        )
+    )
+
+    y = functools.reduce(
+        product,
+        [align(x, keys, all_keys) for (x, keys) in zip(xs, xs_keys)]
+    )
+
+    num_axes = np.ndim(y)
+    summed = tuple(range(num_axes - len(all_keys) + len(out_keys), num_axes))
+    if len(summed) > 0:
+        y = marginal(y, summed)
+    y = np.reshape(y, np.shape(y)[:num_axes-len(summed)])
+    if out is None:
+        return y
+    np.copyto(out, y)
+    return out
 
 
 class SumProduct():
     """ Sum-product distributive law """
 
 
-    def __init__(self, einsum, *args, **kwargs):
+    def __init__(self, einsum, *args, einsum_path=None, optimize="greedy", path_cache_size=1024, **kwargs):
         # Perhaps support for different frameworks (TensorFlow, Theano) could
         # be provided by giving the necessary functions.
         self.func = einsum
         self.args = args
         self.kwargs = kwargs
+
+        # If a path function (e.g., numpy.einsum_path) is given, contractions
+        # of more than two operands are split into pairwise contractions. The
+        # contraction plan is found once for each combination of keys and
+        # operand shapes and then reused from a bounded LRU cache. Statistics
+        # are available from self.contraction_plan.cache_info().
+        self.einsum_path = einsum_path
+        self.optimize = optimize
+        self.path_cache_size = path_cache_size
+        self.contraction_plan = functools.lru_cache(maxsize=path_cache_size)(
+            self._find_contraction_plan
+        )
+        return
+
+    def __getstate__(self):
+        # The plan cache can't be pickled so it is created again when the
+        # distributive law is unpickled (e.g., in a worker process)
+        state = self.__dict__.copy()
+        del state["contraction_plan"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.contraction_plan = functools.lru_cache(maxsize=self.path_cache_size)(
+            self._find_contraction_plan
+        )
         return
 
     def einsum(self, *args, **kwargs):
-        return self.func(*args, *self.args, **kwargs, **self.kwargs)
+        # Contractions of one or two operands have only one possible path,
+        # so einsum is called directly for them
+        if self.einsum_path is None or len(args) <= 5 or isinstance(args[0], str):
+            return self.func(*args, *self.args, **kwargs, **self.kwargs)
+
+        (operands, xs_keys, y_keys) = parse_einsum_args(args)
+        plan = self.contraction_plan(
+            tuple(tuple(keys) for keys in xs_keys + [y_keys]),
+            tuple(np.shape(x) for x in operands)
+        )
+        if plan is None:
+            return self.func(*args, *self.args, **kwargs, **self.kwargs)
+        # Only the last step writes into the given output array
+        out = kwargs.pop("out", None)
+        for (step, (inds, step_keys, out_keys)) in enumerate(plan, start=1):
+            xs = [operands.pop(i) for i in inds]
+            if step == len(plan) and out is not None:
+                kwargs["out"] = out
+            operands.append(
+                self.func(
+                    *[arg for x_and_keys in zip(xs, step_keys) for arg in x_and_keys],
+                    out_keys,
+                    *self.args,
+                    **kwargs,
+                    **self.kwargs
+                )
+            )
+        return operands[0]
+
+    def _find_contraction_plan(self, keys, shapes):
+        """
+        Find pairwise contraction steps for given keys and operand shapes
+
+        Input:
+        ------
+
+        Tuple of keys of each operand followed by output keys
+
+        Shapes of the operands
+
+        Output:
+        -------
+
+        List of steps (operand indices in decreasing order, keys of the
+            operands, keys of the intermediate result) where the operands
+            are removed from the list of operands and the intermediate
+            result is appended to it (as in numpy.einsum_path)
+
+        None if the keys are out of the range accepted by the path function
+            (the contraction is then left to the einsum function, see
+            einsum in this module)
+
+        """
+
+        (xs_keys, y_keys) = (list(keys[:-1]), list(keys[-1]))
+        if any(exceeds_einsum_labels(x_keys) for x_keys in keys):
+            return None
+
+        # Intermediate results are limited to the size of the largest operand
+        # or the output so that the path doesn't increase peak memory usage
+        key_sizes = {}
+        for (shape, x_keys) in zip(shapes, xs_keys):
+            for (key, size) in zip(
+                    [key for key in x_keys if key is not Ellipsis],
+                    shape[len(shape)-len(x_keys)+(Ellipsis in x_keys):]
+            ):
+                # axes of size one are broadcast
+                key_sizes[key] = max(size, key_sizes.get(key, 1))
+        batch_size = max(
+            [
+                int(np.prod(shape[:len(shape)-len(x_keys)+(Ellipsis in x_keys)]))
+                for (shape, x_keys) in zip(shapes, xs_keys)
+            ]
+        )
+        memory_limit = max(
+            [int(np.prod(shape)) for shape in shapes]
+            + [
+                batch_size * int(
+                    np.prod([key_sizes[key] for key in y_keys if key is not Ellipsis])
+                )
+            ]
+        )
+        optimize = (
+            (self.optimize, memory_limit) if isinstance(self.optimize, str) else
+            self.optimize
+        )
+
+        # path search needs only the shapes so use arrays without data
+        (path, _) = self.einsum_path(
+            *[
+                arg
+                for (shape, x_keys) in zip(shapes, xs_keys)
+                for arg in (np.broadcast_to(0.0, shape), list(x_keys))
+            ],
+            y_keys,
+            optimize=optimize
+        )
+
+        plan = []
+        for inds in path[1:]:
+            inds = sorted(inds, reverse=True)
+            step_keys = [list(xs_keys.pop(i)) for i in inds]
+            if len(xs_keys) == 0:
+                out_keys = y_keys
+            else:
+                # keep the keys needed later (and batch axes)
+                needed = set(y_keys).union(*xs_keys)
+                out_keys = list(
+                    dict.fromkeys(
+                        [
+                            key
+                            for keys in step_keys
+                            for key in keys
+                            if key is Ellipsis or key in needed
+                        ]
+                    )
+                )
+            plan.append((inds, step_keys, out_keys))
+            xs_keys.append(out_keys)
+
+        return plan
+
+    def ones(self, shape, dtype=None):
+        """
+        Potential which is neutral in products (e.g., initial separator
+            potential)
+
+        """
+        return np.ones(shape, dtype=dtype)
+
+    def zeros(self, shape, dtype=None):
+        """
+        Potential which is absorbing in products (e.g., impossible states)
+
+        """
+        return np.zeros(shape, dtype=dtype)
+
+    def multiply(self, x, y, out=None):
+        """
+        Elementwise product of two potentials (with broadcasting)
+
+        """
+        return np.multiply(x, y, out=out)
+
+    def add(self, x, y, out=None):
+        """
+        Elementwise sum of two potentials, that is, the marginal of the
+            union of the states over which x and y have been marginalized
+
+        """
+        return np.add(x, y, out=out)
 
+    def divide(self, x, y, out):
+        """
+        Elementwise quotient of two potentials stored in out
+
+        Entries of out where y is zero are not written. Thus, giving y as
+            out computes the quotient in place with 0/0 = 0.
+
+        """
+        return np.divide(x, y, out=out, where=(y != 0))
 
     def project(self, clique_pot, clique_keys, sep_keys):
         """
@@ -39,16 +625,34 @@ class SumProduct():
         """
 
         # map keys to get around variable count limitation in einsum
-        mapped_keys = []
-        m_keys = {}
-        for i,k in enumerate(clique_keys):
-            m_keys[k] = i
-            mapped_keys.append(i)
+        # (leading axes not covered by keys are batch axes)
+        (mapped_keys, mapped_sep_keys) = map_sublist_keys(
+            tuple(clique_keys),
+            tuple(sep_keys)
+        )
+
+        return self.project_mapped(clique_pot, mapped_keys, mapped_sep_keys)
+
+    def project_mapped(self, clique_pot, clique_keys, sep_keys, out=None):
+        """
+        Same as project but keys are assumed to be already mapped to
+            integers accepted by einsum (no key mapping done here)
+
+        If out is given, the separator potential is stored in it.
+
+        """
 
+        if out is None:
+            return self.einsum(
+                clique_pot,
+                clique_keys,
+                sep_keys
+            )
         return self.einsum(
             clique_pot,
-            mapped_keys,
-            [m_keys[k] for k in sep_keys]
+            clique_keys,
+            sep_keys,
+            out=out
         )
 
     def absorb(self, clique_pot, clique_keys, sep_pot, new_sep_pot, sep_keys):
@@ -76,22 +680,119 @@ class SumProduct():
         Updated clique potential
 
         """
-        if np.all(sep_pot) == 0:
-            return np.zeros_like(clique_pot)
-
         # map keys to get around variable count limitation in einsum
-        mapped_keys = []
-        m_keys = {}
-        for i,k in enumerate(clique_keys):
-            m_keys[k] = i
-            mapped_keys.append(i)
+        # (leading axes not covered by keys are batch axes)
+        (mapped_keys, mapped_sep_keys) = map_sublist_keys(
+            tuple(clique_keys),
+            tuple(sep_keys)
+        )
+
+        return self.absorb_mapped(
+            clique_pot,
+            mapped_keys,
+            sep_pot,
+            new_sep_pot,
+            mapped_sep_keys
+        )
+
+    def absorb_mapped(self, clique_pot, clique_keys, sep_pot, new_sep_pot, sep_keys):
+        """
+        Same as absorb but keys are assumed to be already mapped to
+            integers accepted by einsum (no key mapping done here)
+
+        """
+
+        # Zero separator entries are handled elementwise by defining 0/0 = 0
+        # (see Huang and Darwiche, 1996). This way a zero in one scenario of
+        # a batch doesn't affect the other scenarios.
+        ratio = np.divide(
+            new_sep_pot,
+            sep_pot,
+            out=np.zeros(
+                broadcast_shape(np.shape(new_sep_pot), np.shape(sep_pot)),
+                dtype=np.result_type(new_sep_pot, sep_pot, 1.0)
+            ),
+            where=(sep_pot != 0)
+        )
 
         return self.einsum(
-            new_sep_pot / sep_pot, [m_keys[k] for k in sep_keys],
-            clique_pot, mapped_keys,
-            mapped_keys
+            ratio, sep_keys,
+            clique_pot, clique_keys,
+            clique_keys
+        )
+
+    def absorb_inplace(self, clique_pot, sep_pot, new_sep_pot, alignment):
+        """
+        Same as absorb_mapped but the clique potential is updated in place
+            and the old separator potential is overwritten with the
+            quotient of the new and the old separator potentials
+
+        Input:
+        ------
+
+        Clique potential to be updated (in place)
+
+        Old separator potential (overwritten)
+
+        New separator potential
+
+        Alignment of separator axes to clique axes (see compile_alignment)
+
+        Output:
+        -------
+
+        Updated clique potential
+
+        """
+
+        # Where the old separator is zero, it is left as is which gives 0/0 = 0
+        ratio = self.divide(new_sep_pot, sep_pot, out=sep_pot)
+
+        return self.multiply(
+            clique_pot,
+            run_alignment(ratio, alignment),
+            out=clique_pot
         )
 
+    def project_chunked(self, clique_pot, clique_keys, sep_keys, chunks, out=None):
+        """
+        Same as project_mapped but the clique potential is read in chunks
+
+        The chunks must not split the separator axes (see tile_slices).
+            Thus, the projections of the chunks have the shape of the
+            separator and they are added together (into out if given). This
+            bounds the temporary memory of the projection and the clique
+            potential doesn't need to fit in memory (e.g., it can be a
+            numpy.memmap array).
+
+        """
+
+        for (i, index) in enumerate(chunks):
+            part = self.project_mapped(clique_pot[index], clique_keys, sep_keys)
+            if i > 0:
+                self.add(out, part, out=out)
+            elif out is None:
+                out = part
+            else:
+                np.copyto(out, part)
+        return out
+
+    def absorb_chunked(self, clique_pot, sep_pot, new_sep_pot, alignment, chunks):
+        """
+        Same as absorb_inplace but the clique potential is updated in chunks
+
+        The chunks must not split the separator axes (see project_chunked).
+
+        """
+
+        ratio = run_alignment(
+            self.divide(new_sep_pot, sep_pot, out=sep_pot),
+            alignment
+        )
+        for index in chunks:
+            self.multiply(clique_pot[index], ratio, out=clique_pot[index])
+        return clique_pot
+
     def update(self, clique1_pot, clique1_keys, clique2_pot, clique2_keys, sep_pot, sep1_keys, sep2_keys):
         """
         A single update (message pass) from clique1 to clique2
@@ -141,3 +842,125 @@ class SumProduct():
 
         return (new_clique2_pot, new_sep_pot) # may return unchanged clique_a
                                              # too if it helps elsewhere
+
+    def update_mapped(self, clique1_pot, clique1_keys, clique2_pot, clique2_keys, sep_pot, sep1_keys, sep2_keys):
+        """
+        Same as update but keys are assumed to be already mapped to
+            integers accepted by einsum (no key mapping done here)
+
+        Used when running a compiled message schedule where the mapping
+            has been done once at compile time.
+
+        """
+
+        new_sep_pot = self.project_mapped(
+                                clique1_pot,
+                                clique1_keys,
+                                sep1_keys
+        )
+
+        new_clique2_pot = self.absorb_mapped(
+                                clique2_pot,
+                                clique2_keys,
+                                sep_pot,
+                                new_sep_pot,
+                                sep2_keys
+        )
+
+        return (new_clique2_pot, new_sep_pot)
+
+
+class LogSumProduct(SumProduct):
+    """
+    Sum-product distributive law for potentials given in log space
+
+    Products become sums and sums are computed with max-shifted
+        log-sum-exp. Thus, long chains of small probabilities don't
+        underflow and single precision floats can be used.
+    """
+
+    def __init__(self):
+        super().__init__(None)
+        return
+
+    def einsum(self, *args, out=None):
+        """
+        Log-space equivalent of numpy.einsum in sublist format: log of the
+            einsum of the exponentiated arrays
+
+        """
+
+        return contract(args, np.add, logsumexp, out=out)
+
+    def ones(self, shape, dtype=None):
+        return np.zeros(shape, dtype=dtype)
+
+    def zeros(self, shape, dtype=None):
+        return np.full(shape, -np.inf, dtype=dtype)
+
+    def multiply(self, x, y, out=None):
+        return np.add(x, y, out=out)
+
+    def add(self, x, y, out=None):
+        return np.logaddexp(x, y, out=out)
+
+    def divide(self, x, y, out):
+        return np.subtract(x, y, out=out, where=(y != -np.inf))
+
+    def absorb_mapped(self, clique_pot, clique_keys, sep_pot, new_sep_pot, sep_keys):
+        """
+        Same as absorb but keys are assumed to be already mapped to
+            integers accepted by einsum (no key mapping done here)
+
+        """
+
+        # Division becomes subtraction, and -inf separator entries (zeros)
+        # are handled by defining 0/0 = 0
+        ratio = np.subtract(
+            new_sep_pot,
+            sep_pot,
+            out=np.full(
+                broadcast_shape(np.shape(new_sep_pot), np.shape(sep_pot)),
+                -np.inf,
+                dtype=np.result_type(new_sep_pot, sep_pot, 1.0)
+            ),
+            where=(sep_pot != -np.inf)
+        )
+
+        return self.einsum(
+            ratio, sep_keys,
+            clique_pot, clique_keys,
+            clique_keys
+        )
+
+
+class MaxProduct(SumProduct):
+    """
+    Max-product (Viterbi) distributive law
+
+    After propagation the clique potentials are max-marginals, that is,
+        the maximum of the joint over the keys not in the clique. The most
+        probable joint assignment can then be decoded with
+        beliefpropagation.find_map_assignment.
+    """
+
+    def __init__(self):
+        super().__init__(None)
+        return
+
+    def einsum(self, *args, out=None):
+        """
+        Equivalent of numpy.einsum in sublist format with maximization
+            instead of summation
+
+        """
+
+        return contract(
+            args,
+            np.multiply,
+            lambda x, axes: np.max(x, axis=axes, keepdims=True),
+            out=out
+        )
+
+    def add(self, x, y, out=None):
+        return np.maximum(x, y, out=out)
@@ -43,8 +43,8 @@ if __name__ == "__main__":
     # Setup for BayesPy
     setup(
         install_requires = [
-            "numpy",
-            "attrs",
+            "numpy>=1.20",
+            "attrs>=19.2.0",
         ],
         packages         = find_packages(),
         name             = NAME,
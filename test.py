@@ -6,9 +6,13 @@ import networkx as nx
 import itertools
 import heapq
 import copy
+import io
 import junctiontree.junctiontree as jt
-from junctiontree.sum_product import SumProduct
+from junctiontree.sum_product import SumProduct, logsumexp, chunk_slices, tensordot_contract
 import math
+import pickle
+import tempfile
+import os
 
 
 # Tests here using pytest
@@ -908,6 +912,143 @@ class TestHUGINFunctionality(unittest.TestCase):
                     ]
         )
 
+    def test_compiled_schedule(self):
+        tree = [
+                0,
+                (
+                    4,
+                    [
+                        1,
+                        (
+                            5,
+                            [
+                                2,
+                            ]
+                        )
+                    ]
+                ),
+                (
+                    6,
+                    [
+                        3,
+                    ]
+                )
+        ]
+        node_list = [["a","b"],["b","c"],["c","d"],["a","e"],["b"],["c"],["a"]]
+        sizes = {"a": 2, "b": 3, "c": 4, "d": 5, "e": 6}
+        potentials = [
+                        np.random.rand(*[sizes[key] for key in keys])
+                        if ix < 4 else np.ones([sizes[key] for key in keys])
+                        for ix, keys in enumerate(node_list)
+        ]
+
+        schedule = bp.compile_schedule(tree, node_list)
+
+        # collect messages are passed before distribute messages
+        assert [(m[0], m[2]) for m in schedule] == [
+                                                        (2, 1),
+                                                        (1, 0),
+                                                        (3, 0),
+                                                        (0, 1),
+                                                        (1, 2),
+                                                        (0, 3),
+        ]
+
+        assert_potentials_equal(
+            bp.run_schedule(schedule, copy.deepcopy(potentials), bp.sum_product),
+            bp.hugin(tree, node_list, copy.deepcopy(potentials), bp.sum_product)
+        )
+
+    def test_shafer_shenoy(self):
+        tree = [
+                0,
+                (
+                    4,
+                    [
+                        1,
+                        (
+                            5,
+                            [
+                                2,
+                            ]
+                        )
+                    ]
+                ),
+                (
+                    6,
+                    [
+                        3,
+                    ]
+                )
+        ]
+        node_list = [["a","b"],["b","c"],["c","d"],["a","e"],["b"],["c"],["a"]]
+        sizes = {"a": 2, "b": 3, "c": 4, "d": 5, "e": 6}
+        potentials = [
+                        np.random.rand(*[sizes[key] for key in keys])
+                        if ix < 4 else np.ones([sizes[key] for key in keys])
+                        for ix, keys in enumerate(node_list)
+        ]
+        # zeros in separators
+        potentials[1][1] = 0
+
+        for law in (bp.sum_product, bp.max_product):
+            assert_potentials_equal(
+                bp.shafer_shenoy(tree, node_list, potentials[:4], law),
+                bp.hugin(tree, node_list, copy.deepcopy(potentials), law)
+            )
+
+    def test_pickle_distributive_laws(self):
+        for law in (bp.sum_product, bp.log_sum_product, bp.max_product):
+            unpickled = pickle.loads(pickle.dumps(law))
+            assert type(unpickled) == type(law)
+            assert unpickled.contraction_plan.cache_info().currsize == 0
+            np.testing.assert_allclose(
+                unpickled.einsum(np.ones((2, 3)), [0, 1], np.ones(3), [1], [0]),
+                law.einsum(np.ones((2, 3)), [0, 1], np.ones(3), [1], [0])
+            )
+
+    def test_cached_contraction_paths(self):
+        law = SumProduct(np.einsum, einsum_path=np.einsum_path, path_cache_size=2)
+        sizes = [2, 3, 4, 5, 6]
+        keys = [[0, 1], [1, 2], [2, 3], [3, 4], [4, 0]]
+        xs = [np.random.rand(sizes[i], sizes[j]) for (i, j) in keys]
+        args = [arg for (x, x_keys) in zip(xs, keys) for arg in (x, x_keys)]
+
+        for y_keys in ([0, 2], [], [4, 3, 2, 1, 0]):
+            np.testing.assert_allclose(
+                law.einsum(*args, y_keys),
+                np.einsum(*args, y_keys)
+            )
+            # batch axes
+            batch_xs = [np.random.rand(7, *np.shape(x)) for x in xs[:2]] + xs[2:]
+            batch_args = [
+                arg
+                for (x, x_keys) in zip(batch_xs, keys)
+                for arg in (x, [Ellipsis] + x_keys)
+            ] + [[Ellipsis] + y_keys]
+            np.testing.assert_allclose(
+                law.einsum(*batch_args),
+                np.einsum(*batch_args)
+            )
+
+        info = law.contraction_plan.cache_info()
+        assert (info.hits, info.misses, info.currsize) == (0, 6, 2)
+        # evicted plan is found again and then reused
+        law.einsum(*args, [0, 2])
+        law.einsum(*args, [0, 2])
+        info = law.contraction_plan.cache_info()
+        assert (info.hits, info.misses) == (1, 7)
+
+        # few operands are passed directly to einsum
+        law.einsum(xs[0], [0, 1], xs[1], [1, 2], [0, 2])
+        assert law.contraction_plan.cache_info().misses == 7
+
+        # only the last pairwise contraction is stored in the output array
+        out = np.empty((2, 4))
+        y = law.einsum(*args, [0, 2], out=out)
+        assert y is out
+        np.testing.assert_allclose(out, np.einsum(*args, [0, 2]))
+
     def test_evidence_shrinking(self):
         A = np.random.rand(3,4,2) # vars: a,b,c
         a = [0]*3
@@ -1303,6 +1444,147 @@ class TestJunctionTreeConstruction(unittest.TestCase):
         assert ["G","H","J"] in cliques
 
 
+    def test_triangulation_heuristics(self):
+        # 3x3 grid with varying key sizes
+        key = lambda i, j: "x{0}{1}".format(i, j)
+        _vars = {key(i, j): 2 + (i + j) % 3 for i in range(3) for j in range(3)}
+        factors = [
+                    [key(i, j), key(i, j+1)] for i in range(3) for j in range(2)
+        ] + [
+                    [key(i, j), key(i+1, j)] for i in range(2) for j in range(3)
+        ]
+        values = [
+                    np.random.rand(*[_vars[key] for key in factor])
+                    for factor in factors
+        ]
+
+        expected = jt.create_junction_tree(factors, _vars).propagate(values)
+
+        for heuristic in [
+                            "min_fill",
+                            "weighted_min_fill",
+                            "min_degree",
+                            "min_weight",
+                            "random_restarts",
+                            bp.RandomRestarts("min_degree", restarts=3, seed=1),
+        ]:
+            tri, ics, max_cliques, factor_to_maxclique = bp.find_triangulation(
+                                                                factors,
+                                                                _vars,
+                                                                heuristic
+            )
+            for factor_ix, clique_ix in enumerate(factor_to_maxclique):
+                assert set(factors[factor_ix]) <= set(max_cliques[clique_ix])
+
+            tree = jt.create_junction_tree(factors, _vars, heuristic=heuristic)
+            assert_potentials_equal(tree.propagate(values), expected)
+
+        # restarts never do worse than the deterministic heuristic
+        assert bp.total_clique_size(
+                    bp.find_triangulation(factors, _vars, "random_restarts")[2],
+                    _vars
+        ) <= bp.total_clique_size(
+                    bp.find_triangulation(factors, _vars, "min_fill")[2],
+                    _vars
+        )
+
+        with self.assertRaises(ValueError):
+            bp.find_triangulation(factors, _vars, "unknown")
+
+    def test_estimate_cost(self):
+        # 3x3 grid with varying key sizes, a separate component and a factor
+        # over a single key
+        key = lambda i, j: "x{0}{1}".format(i, j)
+        _vars = {key(i, j): 2 + (i + j) % 3 for i in range(3) for j in range(3)}
+        _vars.update({"y": 3, "z": 4})
+        factors = [
+                    [key(i, j), key(i, j+1)] for i in range(3) for j in range(2)
+        ] + [
+                    [key(i, j), key(i+1, j)] for i in range(2) for j in range(3)
+        ] + [
+                    ["y", "z"], ["z"]
+        ]
+
+        for heuristic in ["min_fill", "min_degree", "min_weight"]:
+            cost = bp.estimate_cost(factors, _vars, heuristic, itemsize=4)
+            tree = jt.create_junction_tree(factors, _vars, heuristic=heuristic)
+            maxcliques = tree.clique_tree.maxcliques
+
+            assert cost["num_cliques"] == len(maxcliques)
+            assert cost["treewidth"] == max(map(len, maxcliques)) - 1
+            assert cost["max_clique_size"] == max(
+                bp.state_space_size(maxclique, _vars)
+                for maxclique in maxcliques
+            )
+            assert cost["clique_size"] == bp.total_clique_size(maxcliques, _vars)
+            assert cost["separator_size"] == bp.total_clique_size(
+                tree.separators,
+                _vars
+            )
+            assert cost["memory"] == 4 * (
+                cost["clique_size"] + cost["separator_size"]
+            )
+            assert cost["flops"] > 2 * cost["clique_size"]
+
+        assert bp.estimate_cost([], {})["num_cliques"] == 0
+
+    def test_elimination_ordering_with_incremental_updates(self):
+
+        def full_rescoring_ordering(factors, key_sizes, heuristic):
+            # rescore every remaining key after each elimination
+            adjacency = bp.factors_to_adjacency(factors)
+            rank = bp.key_ranks(key_sizes.keys())
+            ordering = []
+            while adjacency:
+                def score(key):
+                    neighbors = sorted(adjacency[key], key=rank.get)
+                    fill_edges = [
+                        (n1, n2)
+                        for i, n1 in enumerate(neighbors)
+                            for n2 in neighbors[i+1:] if n2 not in adjacency[n1]
+                    ]
+                    return list(heuristic(key, neighbors, fill_edges, key_sizes)) + [rank[key]]
+                key = min(adjacency, key=score)
+                neighbors = adjacency.pop(key)
+                for n1 in neighbors:
+                    adjacency[n1].discard(key)
+                    adjacency[n1].update(neighbors - set([n1]))
+                ordering.append(key)
+            return ordering
+
+        np.random.seed(0)
+        for _ in range(20):
+            keys = ["k{0}".format(i) for i in range(10)]
+            key_sizes = {key: np.random.randint(2, 5) for key in keys}
+            factors = [
+                list(np.random.choice(keys, np.random.randint(1, 4), replace=False))
+                for _ in range(8)
+            ]
+            key_sizes = {
+                key: size for (key, size) in key_sizes.items()
+                if any(key in factor for factor in factors)
+            }
+            for heuristic in bp.heuristics.values():
+                ordering, _ = bp.find_elimination_ordering(
+                                                    key_sizes,
+                                                    bp.factors_to_adjacency(factors),
+                                                    heuristic
+                )
+                assert [key for (key, _) in ordering] == full_rescoring_ordering(
+                                                                    factors,
+                                                                    key_sizes,
+                                                                    heuristic
+                )
+
+        # keys don't need to be comparable with each other
+        factors = [[0, "a"], ["a", (1, 2)], [(1, 2), 0]]
+        _, _, max_cliques, factor_to_maxclique = bp.find_triangulation(
+                                                    factors,
+                                                    {0: 2, "a": 2, (1, 2): 2}
+        )
+        for factor_ix, clique_ix in enumerate(factor_to_maxclique):
+            assert set(factors[factor_ix]) <= set(max_cliques[clique_ix])
+
     def test_identify_cliques(self):
         """
             test_identify_cliques
@@ -1344,6 +1626,44 @@ class TestJunctionTreeConstruction(unittest.TestCase):
         assert ["A","B","D"] in cliques
         assert ["A","D","E"] in cliques
 
+    def test_construct_junction_tree(self):
+        key_sizes = {"A": 2, "B": 3, "C": 2, "D": 4, "E": 2, "F": 2, "G": 2}
+        cliques = [
+                    ["A", "B", "C"],
+                    ["B", "C", "D"],
+                    ["C", "D", "E"],
+                    ["B", "E"],
+                    ["F", "G"], # not connected to other cliques
+                    ["G"],
+        ]
+
+        tree, separators = bp.construct_junction_tree(cliques, key_sizes)
+
+        assert len(separators) == len(cliques) - 1
+        # separator ID -> IDs of the two cliques connected by the separator
+        sep_cliques = {}
+        for pair in bp.generate_potential_pairs(tree):
+            ss_ix = max(pair)
+            sep_cliques.setdefault(ss_ix, set()).add(min(pair))
+        edges = set(
+            [
+                (frozenset(c_ixs), frozenset(separators[ss_ix - len(cliques)]))
+                for (ss_ix, c_ixs) in sep_cliques.items()
+            ]
+        )
+
+        # largest separators are selected first, ties broken by clique sizes
+        assert edges == set(
+            [
+                (frozenset((0, 1)), frozenset(("B", "C"))),
+                (frozenset((1, 2)), frozenset(("C", "D"))),
+                (frozenset((0, 3)), frozenset(("B",))),
+                (frozenset((4, 5)), frozenset(("G",))),
+                # unconnected trees are joined through the smallest cliques
+                (frozenset((5, 3)), frozenset()),
+            ]
+        )
+
     def test_join_trees_with_single_cliques(self):
         tree1 = [0,]
         sepset = [2,]
@@ -1888,6 +2208,571 @@ class TestJunctionTreeInference(unittest.TestCase):
                                 atol=0.01
         )
 
+    def test_batched_propagation(self):
+        tree = jt.create_junction_tree(self.factors, self.key_sizes)
+
+        # three scenarios for the first two factors, the others are shared
+        batch_values = [
+                        np.random.rand(3, *np.shape(value)) if ix < 2 else value
+                        for ix, value in enumerate(self.values)
+        ]
+        # a scenario with zeros in separator potentials
+        batch_values[0][1] = np.array([1.0, 0.0])
+
+        prop_values = tree.propagate(batch_values)
+
+        for i in range(3):
+            values = [
+                        value[i] if ix < 2 else value
+                        for ix, value in enumerate(batch_values)
+            ]
+            for (batch_value, value) in zip(prop_values, tree.propagate(values)):
+                np.testing.assert_allclose(batch_value[i], value)
+
+        # the ratio of separators with more than 32 axes is broadcast too
+        sep_pot = np.random.rand(3, *[1] * 34, 2)
+        sep_pot[1] = 0
+        new_sep_pot = np.random.rand(*[1] * 34, 2)
+        keys = [Ellipsis] + list(range(35))
+        for (law, transform) in (
+                (bp.sum_product, lambda x: x),
+                (bp.log_sum_product, np.log),
+        ):
+            with np.errstate(divide="ignore"):
+                clique_pot = law.absorb_mapped(
+                    transform(np.ones((*[1] * 34, 2))),
+                    keys,
+                    transform(sep_pot),
+                    transform(new_sep_pot),
+                    keys
+                )
+                assert clique_pot.shape == (3, *[1] * 34, 2)
+                np.testing.assert_allclose(
+                    clique_pot,
+                    transform(
+                        np.divide(
+                            new_sep_pot,
+                            sep_pot,
+                            out=np.zeros(sep_pot.shape),
+                            where=(sep_pot != 0)
+                        )
+                    )
+                )
+
+    def test_log_space_propagation(self):
+        tree = jt.create_junction_tree(self.factors, self.key_sizes)
+
+        values = tree.propagate(self.values)
+        with np.errstate(divide="ignore"):
+            log_values = [np.log(value) for value in self.values]
+        for dtype in (np.float64, np.float32):
+            prop_values = tree.propagate(
+                [value.astype(dtype) for value in log_values],
+                distributive_law=bp.log_sum_product
+            )
+            for (log_value, value) in zip(prop_values, values):
+                assert log_value.dtype == dtype
+                np.testing.assert_allclose(
+                    np.exp(log_value),
+                    value,
+                    rtol=1e-5
+                )
+
+        # a long chain of small potentials underflows in linear space
+        n = 200
+        factors = [["x%d" % i, "x%d" % (i+1)] for i in range(n)]
+        sizes = {"x%d" % i: 2 for i in range(n+1)}
+        log_potentials = [
+            np.log(np.array([[1e-3, 2e-3], [3e-3, 4e-3]], dtype=np.float32))
+            for _ in range(n)
+        ]
+        tree = jt.create_junction_tree(factors, sizes)
+        prop_values = tree.propagate(
+            log_potentials,
+            distributive_law=bp.log_sum_product
+        )
+        for value in prop_values:
+            assert np.all(np.isfinite(value))
+        # all marginals have the same normalization constant
+        norms = [
+            logsumexp(value, (0, 1)).item() for value in prop_values
+        ]
+        np.testing.assert_allclose(norms, norms[0], rtol=1e-4)
+
+    def test_map_assignment(self):
+        tree = jt.create_junction_tree(self.factors, self.key_sizes)
+        keys = sorted(self.key_sizes)
+
+        def brute_force_map(values):
+            joint = jt.einsum(list(values), list(self.factors), keys)
+            best = np.unravel_index(np.argmax(joint), joint.shape)
+            return {key: int(ind) for (key, ind) in zip(keys, best)}
+
+        np.random.seed(0)
+        for _ in range(5):
+            values = [np.random.rand(*np.shape(value)) for value in self.values]
+            assert tree.find_map_assignment(values) == brute_force_map(values)
+
+        # max-marginals of the factors
+        values = [np.random.rand(*np.shape(value)) for value in self.values]
+        joint = jt.einsum(list(values), list(self.factors), keys)
+        for (factor, max_marginal) in zip(
+                self.factors,
+                tree.propagate(values, distributive_law=bp.max_product)
+        ):
+            np.testing.assert_allclose(
+                max_marginal,
+                np.max(
+                    np.transpose(
+                        joint,
+                        [keys.index(key) for key in factor]
+                        + [i for (i, key) in enumerate(keys) if key not in factor]
+                    ),
+                    axis=tuple(range(len(factor), len(keys)))
+                )
+            )
+
+        # batches are decoded independently
+        batch_values = [
+                        np.random.rand(4, *np.shape(value)) if ix < 3 else value
+                        for ix, value in enumerate(self.values)
+        ]
+        assignment = tree.find_map_assignment(batch_values)
+        for i in range(4):
+            values = [
+                        value[i] if ix < 3 else value
+                        for ix, value in enumerate(batch_values)
+            ]
+            assert (
+                {key: int(ind[i]) for (key, ind) in assignment.items()}
+                == brute_force_map(values)
+            )
+
+    def test_maxclique_without_factors(self):
+        factors = [
+                    ["x0"],
+                    ["x1"],
+                    ["x0", "x1", "x2"],
+                    ["x2", "x3"],
+                    ["x3", "x2", "x4"],
+                    ["x0", "x4", "x5"],
+        ]
+        key_sizes = {"x%d" % i: 2 + i % 2 for i in range(6)}
+        tree = jt.create_junction_tree(factors, key_sizes)
+        # the cycle x0-x2-x4 gives a maxclique without factors
+        assert [] in tree.clique_tree.maxclique_to_factors
+
+        np.random.seed(0)
+        values = [
+            np.random.rand(*[key_sizes[key] for key in factor])
+            for factor in factors
+        ]
+        for (factor, value) in zip(factors, tree.propagate(values)):
+            np.testing.assert_allclose(
+                value,
+                jt.einsum(list(values), list(factors), factor)
+            )
+
+    def test_inplace_propagation(self):
+        tree = jt.create_junction_tree(self.factors, self.key_sizes)
+
+        prop_values = tree.propagate(self.values, inplace=True)
+        for (value, expected) in zip(prop_values, tree.propagate(self.values)):
+            np.testing.assert_allclose(value, expected)
+
+        # buffers are reused and results are not overwritten by later calls
+        buffers = [id(buffer) for buffer in tree.buffers["values"]]
+        copied_values = copy.deepcopy(prop_values)
+        values = [2 * value for value in self.values]
+        values[0] = np.array([1.0, 0.0])
+        new_values = tree.propagate(values, inplace=True)
+        assert sorted(buffers) == sorted(id(buffer) for buffer in tree.buffers["values"])
+        for (value, copied_value) in zip(prop_values, copied_values):
+            np.testing.assert_allclose(value, copied_value)
+        for (value, expected) in zip(new_values, tree.propagate(values)):
+            np.testing.assert_allclose(value, expected)
+
+        # buffers are reallocated for new batch shapes and other laws
+        batch_values = [np.stack([value, 2 * value]) for value in self.values]
+        for (value, expected) in zip(
+                tree.propagate(batch_values, inplace=True),
+                tree.propagate(batch_values)
+        ):
+            np.testing.assert_allclose(value, expected)
+        log_values = [np.log(value + 0.1) for value in self.values]
+        for (value, expected) in zip(
+                tree.propagate(
+                    log_values,
+                    distributive_law=bp.log_sum_product,
+                    inplace=True
+                ),
+                tree.propagate(log_values, distributive_law=bp.log_sum_product)
+        ):
+            np.testing.assert_allclose(value, expected)
+
+    def test_shafer_shenoy_propagation(self):
+        tree = jt.create_junction_tree(self.factors, self.key_sizes)
+
+        batch_values = [
+                        np.random.rand(3, *np.shape(value)) if ix < 2 else value
+                        for ix, value in enumerate(self.values)
+        ]
+        for (value, expected) in zip(
+                tree.propagate(batch_values, algorithm="shafer_shenoy"),
+                tree.propagate(batch_values)
+        ):
+            np.testing.assert_allclose(value, expected)
+
+        with self.assertRaises(ValueError):
+            tree.propagate(self.values, algorithm="shafer_shenoy", inplace=True)
+        with self.assertRaises(ValueError):
+            tree.propagate(self.values, algorithm="lauritzen_spiegelhalter")
+
+    def test_query(self):
+        tree = jt.create_junction_tree(self.factors, self.key_sizes)
+
+        batch_values = [
+                        np.random.rand(3, *np.shape(value)) if ix < 2 else value
+                        for ix, value in enumerate(self.values)
+        ]
+        for evidence in (None, {"D": 1}, {"A": 0, "H": 1}):
+            prop_values = tree.propagate(batch_values, evidence=evidence)
+            for keys in (["F"], ["B", "H"], list(self.key_sizes)):
+                marginals = tree.query(batch_values, keys, evidence=evidence)
+                assert len(marginals) == len(keys)
+                for (key, marginal) in zip(keys, marginals):
+                    ix = next(
+                        ix
+                        for (ix, factor) in enumerate(self.factors)
+                        if key in factor
+                    )
+                    np.testing.assert_allclose(
+                        marginal,
+                        jt.einsum([prop_values[ix]], [self.factors[ix]], [key])
+                    )
+
+        with self.assertRaises(ValueError):
+            tree.query(self.values, ["X"])
+
+        assert tree.query(self.values, []) == []
+
+    def test_parallel_propagation(self):
+        tree = jt.create_junction_tree(self.factors, self.key_sizes)
+
+        # each message is passed once and after the messages it depends on
+        levels = tree.levels
+        messages = [message for level in levels for task in level for message in task]
+        assert sorted(messages, key=tree.schedule.index) == tree.schedule
+        for level in levels:
+            targets = [task[0][2] for task in level]
+            assert len(set(targets)) == len(targets)
+            sources = set(message[0] for task in level for message in task)
+            assert sources.isdisjoint(targets)
+
+        expected = tree.propagate(self.values)
+        for inplace in (False, True):
+            for workers in (1, 4):
+                prop_values = tree.propagate(
+                                self.values,
+                                inplace=inplace,
+                                workers=workers
+                )
+                for (value, expected_value) in zip(prop_values, expected):
+                    np.testing.assert_allclose(value, expected_value)
+
+        with self.assertRaises(ValueError):
+            tree.propagate(self.values, algorithm="shafer_shenoy", workers=4)
+
+    def test_propagate_many(self):
+        tree = jt.create_junction_tree(self.factors, self.key_sizes)
+        evidence = [None, {"D": 1}, {"A": 0, "H": 1}, {"D": 0}]
+
+        (results, metrics) = tree.propagate_many(
+                                        self.values,
+                                        evidence,
+                                        processes=2,
+                                        return_metrics=True
+        )
+        assert len(results) == len(evidence)
+        for (prop_values, e) in zip(results, evidence):
+            expected = tree.propagate(self.values, evidence=e)
+            for (value, expected_value) in zip(prop_values, expected):
+                np.testing.assert_allclose(value, expected_value)
+        assert metrics["scenarios"] == len(evidence)
+        assert metrics["processes"] == 2
+        assert metrics["scenarios_per_second"] > 0
+
+    def test_blocked_propagation(self):
+        tree = jt.create_junction_tree(self.factors, self.key_sizes)
+        batch_values = [
+                        np.random.rand(3, *np.shape(value)) if ix < 2 else value
+                        for ix, value in enumerate(self.values)
+        ]
+
+        for (law, values) in (
+                (bp.sum_product, batch_values),
+                (bp.log_sum_product, [np.log(value) for value in batch_values]),
+                (bp.max_product, batch_values)
+        ):
+            expected = tree.propagate(values, distributive_law=law)
+            with tempfile.TemporaryDirectory() as scratch_dir:
+                for tile_size in (1, 40, None):
+                    for options in (
+                            {},
+                            {"inplace": True},
+                            {"scratch_dir": scratch_dir}
+                    ):
+                        if tile_size is None and not options.get("scratch_dir"):
+                            continue
+                        prop_values = tree.propagate(
+                                        values,
+                                        distributive_law=law,
+                                        tile_size=tile_size,
+                                        **options
+                        )
+                        for (value, expected_value) in zip(prop_values, expected):
+                            assert not isinstance(value, np.memmap)
+                            np.testing.assert_allclose(value, expected_value)
+                # temporary files of out-of-core propagation are removed
+                assert os.listdir(scratch_dir) == []
+
+        with self.assertRaises(ValueError):
+            tree.propagate(self.values, algorithm="shafer_shenoy", scratch_dir=".")
+        with self.assertRaises(ValueError):
+            tree.propagate(self.values, workers=2, tile_size=1024)
+        with self.assertRaises(ValueError):
+            tree.propagate(self.values, inplace=True, scratch_dir=".")
+
+    def test_chunk_slices(self):
+        x = np.random.rand(2, 3, 4, 5)
+        for (axes, max_size) in (([1, 2], 20), ([2], 1), ([3, 1], 50), ([], 1)):
+            chunks = list(chunk_slices(x.shape, axes, max_size))
+            total = np.zeros_like(x)
+            for index in chunks:
+                total[index] += x[index]
+                assert all(
+                    index[axis] == slice(None)
+                    for axis in range(x.ndim)
+                    if axis not in axes
+                )
+                assert x[index].size <= max_size or all(
+                    x[index].shape[axis] == 1 for axis in axes
+                )
+            np.testing.assert_allclose(total, x)
+
+    def test_tensordot_contract(self):
+        # batch axes, broadcast axes of size one, summed and reordered keys
+        args = [
+            np.random.rand(2, 1, 3, 4), [Ellipsis, 0, 1, 2],
+            np.random.rand(3, 1, 5), [Ellipsis, 1, 2, 3],
+            np.random.rand(5, 2), [3, 0],
+            np.random.rand(4), [2],
+        ]
+        for y_keys in ([Ellipsis, 3, 0], [Ellipsis, 1], [Ellipsis], [Ellipsis, 2, 3]):
+            np.testing.assert_allclose(
+                tensordot_contract(args + [y_keys]),
+                np.einsum(*args, y_keys)
+            )
+
+    def test_contraction_with_many_keys(self):
+        # more keys than numpy.einsum supports in one clique
+        wide = ["W%d" % i for i in range(60)]
+        key_sizes = dict({key: 1 for key in wide[3:]}, W0=2, W1=3, W2=2, A=3, B=2)
+        factors = [wide, ["W0", "A"], ["A", "B"], ["W1", "W59", "B"]]
+        values = [np.random.rand(*[key_sizes[key] for key in factor]) for factor in factors]
+
+        tree = jt.create_junction_tree(factors, key_sizes)
+        log_prop_values = tree.propagate(
+            [np.log(value) for value in values],
+            distributive_law=bp.log_sum_product
+        )
+        for prop_values in (
+                tree.propagate(values),
+                tree.propagate(values, inplace=True),
+                tree.propagate(values, tile_size=64),
+        ):
+            for (prop_value, log_prop_value) in zip(prop_values, log_prop_values):
+                np.testing.assert_allclose(np.log(prop_value), log_prop_value)
+
+        joint = jt.einsum(values, factors, wide + ["A", "B"])
+        np.testing.assert_allclose(
+            jt.einsum(values, factors, ["B", "W1"]),
+            jt.einsum([joint], [wide + ["A", "B"]], ["B", "W1"])
+        )
+        np.testing.assert_allclose(
+            tree.query(values, ["A"])[0],
+            np.reshape(joint, (-1, 3, 2)).sum(axis=(0, 2))
+        )
+
+        # two wide cliques with several factors each and a separator of more
+        # than 32 keys
+        shared = ["S%d" % i for i in range(40)]
+        (left, right) = (["L%d" % i for i in range(20)], ["R%d" % i for i in range(20)])
+        factors = [
+            shared + left,
+            shared[:3] + ["L0"],
+            ["S0"] + right,
+            shared + right,
+            ["L0", "C"],
+        ]
+        key_sizes = dict(
+            {key: 1 for factor in factors for key in factor},
+            S0=2, S1=2, L0=3, R0=2, C=2
+        )
+        values = [np.random.rand(*[key_sizes[key] for key in factor]) for factor in factors]
+
+        tree = jt.create_junction_tree(factors, key_sizes)
+        assert max(len(separator) for separator in tree.separators) > 32
+        factor_to_maxclique = list(tree.clique_tree.factor_to_maxclique)
+        wide_cliques = [
+            c_ix
+            for (c_ix, clique) in enumerate(tree.clique_tree.maxcliques)
+            if len(clique) > 32
+        ]
+        assert len(wide_cliques) == 2
+        assert all(factor_to_maxclique.count(c_ix) > 1 for c_ix in wide_cliques)
+        log_prop_values = tree.propagate(
+            [np.log(value) for value in values],
+            distributive_law=bp.log_sum_product
+        )
+        for prop_values in (
+                tree.propagate(values),
+                tree.propagate(values, inplace=True),
+        ):
+            for (prop_value, log_prop_value) in zip(prop_values, log_prop_values):
+                np.testing.assert_allclose(np.log(prop_value), log_prop_value)
+        for key in ("C", "S1", "R0"):
+            np.testing.assert_allclose(
+                tree.query(values, [key])[0],
+                jt.einsum(values, factors, [key])
+            )
+
+    def test_variable_elimination(self):
+        tree = jt.create_junction_tree(self.factors, self.key_sizes)
+        factor_graph = jt.FactorGraph(factors=self.factors, sizes=self.key_sizes)
+        batch_values = [
+                        np.random.rand(3, *np.shape(value)) if ix < 2 else value
+                        for ix, value in enumerate(self.values)
+        ]
+
+        for evidence in (None, {"D": 1}, {"A": 0, "H": 1}):
+            prop_values = tree.propagate(batch_values, evidence=evidence)
+            for (ix, factor) in enumerate(self.factors):
+                for keys in (factor, factor[::-1], factor[:1]):
+                    np.testing.assert_allclose(
+                        factor_graph.eliminate(batch_values, keys, evidence),
+                        jt.einsum([prop_values[ix]], [factor], keys)
+                    )
+
+        for (law, values) in (
+                (bp.log_sum_product, [np.log(value) for value in self.values]),
+                (bp.max_product, self.values)
+        ):
+            np.testing.assert_allclose(
+                factor_graph.eliminate(values, ["F"], distributive_law=law),
+                tree.query(values, ["F"], distributive_law=law)[0]
+            )
+
+        with self.assertRaises(ValueError):
+            factor_graph.eliminate(self.values, ["X"])
+
+        # plans are cached by the base heuristic and the cache is bounded
+        factor_graph.eliminations.clear()
+        for heuristic in ("min_fill", bp.min_degree, bp.RandomRestarts(), bp.RandomRestarts(seed=0)):
+            factor_graph.eliminate(self.values, ["F"], heuristic=heuristic)
+        assert set(factor_graph.eliminations) == {
+            (("F",), bp.min_fill),
+            (("F",), bp.min_degree),
+        }
+        for _ in range(jt.ELIMINATION_CACHE_SIZE + 1):
+            factor_graph.eliminate(self.values, ["F"], heuristic=lambda *args: bp.min_fill(*args))
+        assert len(factor_graph.eliminations) == jt.ELIMINATION_CACHE_SIZE
+
+        # the plan cache is not pickled and trees pickled without it still work
+        unpickled = pickle.loads(pickle.dumps(factor_graph))
+        assert unpickled == factor_graph and unpickled.eliminations == {}
+        old = jt.FactorGraph.__new__(jt.FactorGraph)
+        old.__setstate__({"factors": self.factors, "sizes": self.key_sizes})
+        np.testing.assert_allclose(
+            old.eliminate(self.values, ["F"]),
+            factor_graph.eliminate(self.values, ["F"])
+        )
+
+    def test_variable_elimination_with_many_keys(self):
+        # the whole chain has more keys than einsum supports at once
+        n = 100
+        factors = [["x0"]] + [["x%d" % (i-1), "x%d" % i] for i in range(1, n)]
+        sizes = {"x%d" % i: 2 for i in range(n)}
+        values = [np.random.rand(*[2 for key in factor]) for factor in factors]
+
+        factor_graph = jt.FactorGraph(factors=factors, sizes=sizes)
+        contractions = bp.compile_elimination(factors, sizes, ["x50"])
+        for (_, sublists, _) in contractions:
+            assert len(set(k for keys in sublists for k in keys[1:])) <= 3
+        np.testing.assert_allclose(
+            factor_graph.eliminate(values, ["x50"]),
+            jt.create_junction_tree(factors, sizes).query(values, ["x50"])[0]
+        )
+
+    def test_session(self):
+        tree = jt.create_junction_tree(self.factors, self.key_sizes)
+        session = tree.session(self.values)
+        assert not session.dirty
+
+        def assert_marginals(evidence):
+            prop_values = tree.propagate(self.values, evidence=evidence)
+            for key in self.key_sizes:
+                ix = next(
+                    ix
+                    for (ix, factor) in enumerate(self.factors)
+                    if key in factor
+                )
+                expected = jt.einsum([prop_values[ix]], [self.factors[ix]], [key])
+                marginal = session.marginal(key)
+                if key in evidence:
+                    np.testing.assert_allclose(
+                        marginal[evidence[key]:evidence[key]+1],
+                        expected
+                    )
+                    assert np.count_nonzero(marginal) <= 1
+                else:
+                    np.testing.assert_allclose(marginal, expected)
+
+        session.set_evidence("D", 1)
+        assert session.dirty
+        assert_marginals({"D": 1})
+        assert not session.dirty
+
+        session.set_evidence("A", 0)
+        dirty = session.dirty
+        session.marginal("A")
+        assert session.dirty == dirty
+        assert_marginals({"D": 1, "A": 0})
+
+        session.set_evidence("D", 0)
+        assert_marginals({"D": 0, "A": 0})
+
+        session.retract_evidence("A")
+        assert_marginals({"D": 0})
+
+        session.set_evidence("H", 1)
+        evidence = {"D": 0, "H": 1}
+        prop_values = tree.propagate(self.values, evidence=evidence)
+        results = session.marginals()
+        for (factor, result, expected) in zip(self.factors, results, prop_values):
+            index = tuple(
+                slice(evidence[key], evidence[key]+1)
+                if key in evidence else slice(None)
+                for key in factor
+            )
+            np.testing.assert_allclose(result[index], expected)
+        assert not session.dirty
+
+        with self.assertRaises(ValueError):
+            session.set_evidence("X", 0)
+        with self.assertRaises(ValueError):
+            session.set_evidence("A", self.key_sizes["A"])
+
     def test_initialize_potentials(self):
         j_tree = jt.JunctionTree(
                     self.tree,
@@ -2014,6 +2899,86 @@ class TestJunctionTreeInference(unittest.TestCase):
 
 
 
+    def test_global_propagation_with_evidence(self):
+        key_sizes = {
+                        "cloudy": 2,
+                        "sprinkler": 2,
+                        "rain": 2,
+                        "wet_grass": 2
+                    }
+
+        factors = [
+                    ["cloudy"],
+                    ["cloudy", "sprinkler"],
+                    ["cloudy", "rain"],
+                    ["rain", "sprinkler", "wet_grass"]
+        ]
+
+        values = [
+                    np.array([0.5,0.5]),
+                    np.array([[0.5,0.5],[0.9,0.1]]),
+                    np.array([[0.8,0.2],[0.2,0.8]]),
+                    np.array(
+                                [
+                                    [[1,0],[0.1,0.9]],
+                                    [[0.1,0.9],[0.01,0.99]]
+                                ]
+                    )
+        ]
+
+        tree = jt.create_junction_tree(factors, key_sizes)
+
+        # grass is wet
+        prop_values = tree.propagate(values, evidence={"wet_grass": 1})
+        assert prop_values[3].shape == (2, 2, 1)
+        marginal = np.sum(prop_values[1], axis=0)
+        np.testing.assert_allclose(
+                                marginal/np.sum(marginal),
+                                np.array([0.57024,0.42976]),
+                                atol=0.01
+        )
+
+        # grass is wet and it is raining
+        evidence = {"wet_grass": 1, "rain": 1}
+        prop_values = tree.propagate(values, evidence=evidence)
+        marginal = np.sum(prop_values[1], axis=0)
+        np.testing.assert_allclose(
+                                marginal/np.sum(marginal),
+                                np.array([0.8055,0.1945]),
+                                atol=0.01
+        )
+
+        # same as slicing the factors by hand
+        cond_values = [
+                        values[0],
+                        values[1],
+                        values[2][:,1:],
+                        values[3][1:,:,1:]
+        ]
+        for (value, cond_value) in zip(
+                prop_values,
+                jt.create_junction_tree(
+                    factors,
+                    dict(key_sizes, wet_grass=1, rain=1)
+                ).propagate(cond_values)
+        ):
+            np.testing.assert_allclose(value, cond_value)
+
+        # observed keys keep their values in the most probable assignment
+        assignment = tree.find_map_assignment(values, evidence=evidence)
+        assert assignment["wet_grass"] == 1 and assignment["rain"] == 1
+
+        # batch axes are not affected by evidence
+        batch_values = [np.stack([value, value]) for value in values]
+        for (batch_value, value) in zip(
+                tree.propagate(batch_values, evidence=evidence),
+                prop_values
+        ):
+            np.testing.assert_allclose(batch_value[1], value)
+
+        with self.assertRaises(ValueError):
+            tree.propagate(values, evidence={"wet_grass": 2})
+
     def test_inference(self):
         #http://pages.cs.wisc.edu/~dpage/cs731/lecture5.ppt
         key_sizes = {
@@ -2196,6 +3161,66 @@ class TestJTTraversal(unittest.TestCase):
                                                 ]
 
 
+    def test_array_tree(self):
+        # cliques 0-4, separators 5-8
+        tree = [
+                0,
+                (
+                    5,
+                    [
+                        1,
+                        (
+                            6,
+                            [
+                                2,
+                            ]
+                        ),
+                        (
+                            7,
+                            [
+                                3,
+                            ]
+                        )
+                    ]
+                ),
+                (
+                    8,
+                    [
+                        4,
+                    ]
+                )
+        ]
+
+        array_tree = jt.ArrayTree.from_tree(tree)
+        assert array_tree.root == 0
+        np.testing.assert_array_equal(array_tree.parents, [-1, 0, 1, 1, 0])
+        np.testing.assert_array_equal(array_tree.separators, [-1, 5, 6, 7, 8])
+        np.testing.assert_array_equal(array_tree.order, [0, 1, 2, 3, 4])
+        np.testing.assert_array_equal(array_tree.get_children(1), [2, 3])
+        np.testing.assert_array_equal(array_tree.depths(), [0, 1, 2, 2, 1])
+        assert array_tree.path(2, 4) == [2, 1, 0, 4]
+        assert array_tree.to_tree() == tree
+
+        # re-rooting keeps the edges
+        rerooted = array_tree.reroot(2)
+        assert rerooted.root == 2
+        np.testing.assert_array_equal(rerooted.parents, [1, 2, -1, 1, 0])
+        np.testing.assert_array_equal(rerooted.separators, [5, 6, -1, 7, 8])
+        assert_junction_tree_equal(rerooted.to_tree(), tree)
+
+        # serialization
+        buf = io.BytesIO()
+        np.savez(buf, **array_tree.to_arrays())
+        buf.seek(0)
+        assert jt.ArrayTree.from_arrays(np.load(buf)).to_tree() == tree
+
+        # construction from edges
+        edges = [(0, 1, ["a"]), (1, 2, ["b"]), (1, 3, ["c"]), (0, 4, ["d"])]
+        assert_junction_tree_equal(
+            jt.ArrayTree.from_edges(5, edges).to_tree(),
+            tree
+        )
+
     def test_get_clique_keys(self):
         node_list = [
                         [0, 2, 4],
@@ -108,6 +108,120 @@ def test_clique_graph():
     return
 
 
+def test_clique_graph_evaluate_product():
+
+    factors = [ ['a'], ['c', 'a'], ['b'], ['d', 'b', 'c'], ['c'] ]
+    g = jt.CliqueGraph(
+        maxcliques=[ ['a', 'b', 'c', 'd', 'e'] ],
+        factor_to_maxclique=[0, 0, 0, 0, 0],
+        factor_graph=jt.FactorGraph(
+            factors=factors,
+            sizes={
+                'a': 2,
+                'b': 3,
+                'c': 4,
+                'd': 5,
+                'e': 6,
+            }
+        )
+    )
+
+    # factors that are subsets of larger factors are grouped with them
+    assert [
+        (i, sorted(j for (j, _) in subgroup))
+        for (i, _, subgroup) in g.evaluation_products[0]
+    ] == [(3, [2, 4]), (1, [0])]
+
+    xs = [
+        np.random.rand(7, 2),
+        np.random.rand(4, 2),
+        np.random.rand(3),
+        np.random.rand(5, 3, 4),
+        np.random.rand(4),
+    ]
+    (y,) = g.evaluate(xs)
+    np.testing.assert_allclose(
+        y,
+        np.einsum('za,ca,b,dbc,c->zabcd', *xs)[..., None]
+    )
+
+    # the product of the distributive law is used and the precision is kept
+    (y,) = g.evaluate(
+        [np.log(x).astype(np.float32) for x in xs],
+        distributive_law=jt.bp.log_sum_product
+    )
+    assert y.dtype == np.float32
+    np.testing.assert_allclose(
+        np.exp(y),
+        np.einsum('za,ca,b,dbc,c->zabcd', *xs)[..., None],
+        rtol=1e-5
+    )
+
+    # cliques with more than 32 keys get several factor groups
+    wide = ['w%d' % i for i in range(40)]
+    g = jt.CliqueGraph(
+        maxcliques=[wide + ['b']],
+        factor_to_maxclique=[0, 0, 0],
+        factor_graph=jt.FactorGraph(
+            factors=[wide, ['w0', 'w1'], ['w1', 'b']],
+            sizes=dict({key: 1 for key in wide}, w0=2, w1=3, b=2)
+        )
+    )
+    xs = [np.random.rand(2, 3, *[1] * 38), np.random.rand(2, 3), np.random.rand(3, 2)]
+    (y,) = g.evaluate(xs)
+    assert y.shape == (2, 3) + (1,) * 38 + (2,)
+    np.testing.assert_allclose(
+        np.reshape(y, (2, 3, 2)),
+        np.einsum('ab,ab,bc->abc', np.reshape(xs[0], (2, 3)), xs[1], xs[2])
+    )
+
+    return
+
+
+def test_clique_graph_marginalize():
+
+    g = jt.CliqueGraph(
+        maxcliques=[
+            ['a', 'b', 'c'],
+            ['a', 'c', 'd', 'e'],
+        ],
+        factor_to_maxclique=[0, 0, 1],
+        factor_graph=jt.FactorGraph(
+            factors=[ ['b', 'a'], ['c'], ['d', 'a'] ],
+            sizes={
+                'a': 2,
+                'b': 3,
+                'c': 4,
+                'd': 5,
+                'e': 6,
+            }
+        )
+    )
+
+    # batch axes are kept
+    ys = [
+        np.random.randn(7, 2, 3, 4),
+        np.random.randn(7, 2, 4, 5, 6),
+    ]
+    xs = g.marginalize(ys)
+    np.testing.assert_allclose(xs[0], np.einsum('...abc->...ba', ys[0]))
+    np.testing.assert_allclose(xs[1], np.einsum('...abc->...c', ys[0]))
+    np.testing.assert_allclose(xs[2], np.einsum('...acde->...da', ys[1]))
+
+    # tiled marginalization gives the same results
+    for tile_size in (8, 100, 10**6):
+        for (x, xh) in zip(g.marginalize(ys, tile_size=tile_size), xs):
+            np.testing.assert_allclose(x, xh)
+
+    # the compiled einsums are reused for evaluation with batch axes and keys
+    # missing from the factors
+    zs = g.evaluate([np.random.randn(7, 3, 2), np.random.randn(4), np.random.randn(5, 2)])
+    assert np.shape(zs[0]) == (7, 2, 3, 4)
+    assert np.shape(zs[1]) == (2, 1, 5, 1)
+
+    return
+
+
 def test_junction_tree():
 
     def _run(maxcliques, sizes, tree):
@@ -186,3 +300,52 @@ def test_junction_tree():
     )
 
     return
+
+
+def test_save_and_load_junction_tree(tmp_path):
+    import io
+    import os
+
+    factors = [["a"], ["a", "b"], ["b", "c"], ["c", "d"], ["b", "d"]]
+    sizes = {"a": 2, "b": 3, "c": 4, "d": 2}
+    xs = [np.random.rand(*[sizes[key] for key in factor]) for factor in factors]
+    tree = jt.create_junction_tree(factors, sizes)
+
+    f = io.BytesIO()
+    jt.save_junction_tree(tree, f)
+    f.seek(0)
+    loaded = jt.load_junction_tree(f)
+    assert loaded == tree
+    assert loaded.schedule == tree.schedule
+    for (y, yh) in zip(loaded.propagate(xs), tree.propagate(xs)):
+        np.testing.assert_allclose(y, yh)
+
+    # corrupted files and other format versions are rejected
+    with np.testing.assert_raises(ValueError):
+        jt.load_junction_tree(io.BytesIO(b"not a tree"))
+    with np.testing.assert_raises(ValueError):
+        jt.load_junction_tree(
+            io.BytesIO(f.getvalue().replace(jt.MAGIC + b"\x01\x00", jt.MAGIC + b"\xff\x00"))
+        )
+
+    # the cache is keyed by factors, sizes and heuristic
+    cached = jt.create_junction_tree(factors, sizes, cache_dir=str(tmp_path))
+    assert len(os.listdir(str(tmp_path))) == 1
+    assert jt.create_junction_tree(factors, sizes, cache_dir=str(tmp_path)) == cached
+    assert len(os.listdir(str(tmp_path))) == 1
+    jt.create_junction_tree(factors, dict(sizes, d=3), cache_dir=str(tmp_path))
+    jt.create_junction_tree(factors, sizes, "min_degree", cache_dir=str(tmp_path))
+    assert len(os.listdir(str(tmp_path))) == 3
+    assert (
+        jt.cache_key(factors, sizes, "min_fill")
+        != jt.cache_key(factors, sizes, "min_degree")
+    )
+
+    # corrupted and stale entries are rebuilt
+    path = os.path.join(str(tmp_path), jt.cache_key(factors, sizes) + ".jtree")
+    stale = f.getvalue().replace(b"JunctionTree", b"JunctionTrex")
+    for content in (b"garbage", f.getvalue()[:40], stale):
+        with open(path, "wb") as entry:
+            entry.write(content)
+        assert jt.create_junction_tree(factors, sizes, cache_dir=str(tmp_path)) == tree
+        assert jt.load_junction_tree(path) == tree